@@ -28,7 +28,7 @@ if __name__ == "__main__":
     from twisted.internet import reactor
     from twisted.internet.defer import inlineCallbacks    
     
-    from util import wamp_local, utils, tileset, sendInput, messages, game, consoleInput
+    from util import wamp_local, utils, tileset, glyphset, sendInput, messages, game, consoleInput, governor
     
     #Change this to True for enhanced debugging    
     edebug = False
@@ -67,6 +67,48 @@ if __name__ == "__main__":
             full_debug = Config.getboolean('dfeverywhere', 'DEBUG')
         except:
             full_debug = False
+        try:
+            glyph_mode = Config.getboolean('dfeverywhere', 'GLYPHS')
+        except:
+            glyph_mode = False
+        try:
+            fuzzy_threshold = Config.getint('dfeverywhere', 'FUZZY')
+        except:
+            fuzzy_threshold = 0
+        try:
+            delta_maps = Config.getboolean('dfeverywhere', 'DELTAMAPS')
+        except:
+            delta_maps = False
+        try:
+            binary_maps = Config.getboolean('dfeverywhere', 'BINARYMAPS')
+        except:
+            binary_maps = False
+        try:
+            cpu_budget = Config.getfloat('dfeverywhere', 'CPUBUDGET')
+        except:
+            cpu_budget = 0
+        try:
+            nice = Config.getint('dfeverywhere', 'NICE')
+        except:
+            nice = 0
+        try:
+            cpus = [int(c) for c in Config.get('dfeverywhere', 'CPUS').split(',')]
+        except:
+            cpus = []
+        try:
+            trace_file = Config.get('dfeverywhere', 'TRACE')
+        except:
+            trace_file = ''
+        try:
+            metrics_port = Config.getint('dfeverywhere', 'METRICS')
+        except:
+            metrics_port = 0
+        try:
+            #gtk, shm, composite or damage. shm reads the screen, so frames are skipped while DF is covered.
+            #composite and damage read the window itself, covered or not.
+            capture_method = Config.get('dfeverywhere', 'CAPTURE').strip().lower()
+        except:
+            capture_method = 'gtk'
     except:
         #If file is missing, return blanks
         web_topic = ''
@@ -80,13 +122,47 @@ if __name__ == "__main__":
     
             
     #Change screenshot method based on operating system    
+    shmCapture = None
+    windowTracker = None
     if _platform == "linux" or _platform == "linux2":
         #linux...
         window_handle = []
         window_handle.append(utils.linux_get_windows_bytitle("Dwarf Fortress"))
         try:
-            shot = utils.linux_screenshot(window_handle[0], debug = False)
             shotFunct = utils.linux_screenshot
+            if capture_method in ('shm', 'composite', 'damage'):
+                #X shared memory capture, see util/xcapture.py
+                try:
+                    from util import xcapture
+                    #Follows the window through X events, and finds it again if DF is restarted
+                    windowTracker = xcapture.WindowTracker(title = "Dwarf Fortress", window = window_handle[0].get_xid())
+                    if capture_method == 'damage':
+                        #Only grabs what the game redraws
+                        try:
+                            shmCapture = xcapture.DamageCapture(windowTracker)
+                        except OSError, e:
+                            print("damage capture unavailable (%s). Using composite." % e)
+                            shmCapture = xcapture.CompositeCapture(windowTracker)
+                    elif capture_method == 'composite':
+                        #Reads the window even while it is covered, without activating it
+                        shmCapture = xcapture.CompositeCapture(windowTracker)
+                    else:
+                        shmCapture = xcapture.ShmCapture(windowTracker)
+                    shotFunct = shmCapture.screenshot
+                except (ImportError, OSError), e:
+                    print("%s capture unavailable (%s). Using Gtk." % (capture_method, e))
+                    if windowTracker is not None:
+                        windowTracker.close()
+                        windowTracker = None
+            if shmCapture is None:
+                #Gtk only raises the window while X says it is covered, and follows it if DF is restarted
+                try:
+                    from util import xcapture
+                    windowTracker = xcapture.WindowTracker(title = "Dwarf Fortress", window = window_handle[0].get_xid())
+                    shotFunct = lambda window, debug = False: utils.linux_screenshot(window, debug, windowTracker)
+                except (ImportError, OSError), e:
+                    print("Unable to follow the window through X events (%s)." % e)
+            shot = shotFunct(window_handle[0], debug = False)
         except:
             print("Unable to find Dwarf Fortress window. Ensure that it is running.")
             raw_input('DF Everywhere stopped. Press [enter] to close this window.')
@@ -145,14 +221,44 @@ if __name__ == "__main__":
     
     
     local_file = utils.findLocalImg(tile_x, tile_y)
-    tset = tileset.Tileset(local_file, tile_x, tile_y, array = True, debug = False)
+    tset = tileset.Tileset(local_file, tile_x, tile_y, array = True, debug = False, fuzzy = fuzzy_threshold)
+    if glyph_mode:
+        #Send glyph, foreground and background maps instead of tile maps
+        tset = glyphset.Glyphset(tset)
     
     #Start WAMP client
     client_control = game.Game(web_topic, web_key, shotFunct, window_handle[0], fps = show_fps)    
     client_control.tileset = tset
+    client_control.windowTracker = windowTracker
+    if shmCapture is not None:
+        #Frames go from the shared memory segment to the tileset without PIL or copies
+        client_control.shotFunction = shmCapture.rgbFrame
+        client_control.arrayFrames = True
+        if isinstance(shmCapture, xcapture.DamageCapture):
+            client_control.damageCapture = shmCapture
+    #Keyframes and changes instead of a full map every frame. Needs a viewer that understands them.
+    client_control.sendFullMaps = not (delta_maps or binary_maps)
+    if binary_maps:
+        #Packed uint16 maps, see util/mapframes.py
+        client_control.mapFrames.binary = True
+        if not delta_maps:
+            client_control.mapFrames.keyframeInterval = 1
+    
+    if cpu_budget > 0:
+        #Percent of one core
+        client_control.governor = governor.CpuGovernor(budget = cpu_budget / 100.0)
+    governor.lowerPriority(nice = nice, cpus = cpus)
+    if trace_file:
+        #Chrome trace events for every frame stage
+        client_control.tracer.open(trace_file)
+    
+    if metrics_port:
+        #Prometheus metrics on localhost
+        from util import metrics
+        metrics.listen(client_control, metrics_port)
     
-    #Start input handler
-    inputHandler = consoleInput.ConsoleInput(client_control.stopClean, client_control.reconnect)
+    #Start input handler. [t] prints frame stage timings, [p] starts or stops the profiler.
+    inputHandler = consoleInput.ConsoleInput(client_control.stopClean, client_control.reconnect, client_control.printStages, client_control.toggleProfile)
     reactor.callWhenRunning(inputHandler.start)
     
     reactor.run()
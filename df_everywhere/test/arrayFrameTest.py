@@ -0,0 +1,127 @@
+#
+# Counts the memory allocated per frame from capture buffer to tile ids: the array path against the PIL path.
+# A capture buffer like xcapture.ShmCapture's (BGRX with a black border) is reused for every frame,
+# and a few tiles are redrawn in it each frame.
+#
+
+try:
+    import Image
+except:
+    from PIL import Image
+
+import ctypes
+import ctypes.util
+import resource
+import time
+import numpy
+
+from testHelpers import scratchDir
+from util import tileset, utils
+
+#Allocations over 128 KB always get fresh pages from the system, so page faults count the memory a frame allocates
+libc = ctypes.CDLL(ctypes.util.find_library('c'))
+M_MMAP_THRESHOLD = -3
+libc.mallopt(M_MMAP_THRESHOLD, 128 * 1024)
+
+tile_x = 16
+tile_y = 16
+tiles_x = 80
+tiles_y = 50
+border = 6
+uniqueTiles = 300
+changedPerFrame = 20
+frames = 300
+
+rand = numpy.random.RandomState(0)
+tiles = (rand.rand(uniqueTiles, tile_y, tile_x, 3) * 254 + 1).astype('uint8')
+choice = rand.randint(0, uniqueTiles, size = (tiles_y, tiles_x))
+
+#BGRX capture buffer, DF drawn inside a black border
+buf = numpy.zeros((tiles_y * tile_y + 2 * border, tiles_x * tile_x + 2 * border, 4), dtype = numpy.uint8)
+rgb = buf[..., 2::-1]
+screen = rgb[border:-border, border:-border]
+screen[...] = tiles[choice].swapaxes(1, 2).reshape(tiles_y * tile_y, tiles_x * tile_x, 3)
+
+#Rectangles drawn since the last frame, in capture buffer coordinates, like xcapture.DamageCapture.dirty
+damage = []
+
+def redraw(frame):
+    """
+    Draws a few known tiles in new places, like DF updating the screen.
+    """
+    for i in xrange(changedPerFrame):
+        n = (frame * changedPerFrame + i) * 7919
+        y, x = n / tiles_x % tiles_y, n % tiles_x
+        screen[y * tile_y:(y + 1) * tile_y, x * tile_x:(x + 1) * tile_x] = tiles[n % uniqueTiles]
+        damage.append((border + x * tile_x, border + y * tile_y, tile_x, tile_y))
+
+class ArrayPath:
+    def __init__(self):
+        self.tset = tileset.Tileset(None, tile_x, tile_y, array = True)
+        self.box = None
+    def frame(self):
+        self.box = utils.trimBox(rgb, self.box)
+        return self.tset.parseImageIds(utils.trimArray(rgb, self.box))
+
+class DirtyPath(ArrayPath):
+    """
+    Array path that only looks at the tiles under the damaged rectangles.
+    """
+    def frame(self):
+        self.box = utils.trimBox(rgb, self.box)
+        left, top = self.box[:2]
+        dirty = [(x - left, y - top, w, h) for x, y, w, h in damage]
+        del damage[:]
+        return self.tset.parseImageIds(utils.trimArray(rgb, self.box), dirty)
+
+class PilPath:
+    def __init__(self):
+        self.tset = tileset.Tileset(None, tile_x, tile_y, array = True)
+    def frame(self):
+        height, width = buf.shape[:2]
+        shot = Image.frombuffer('RGB', (width, height), buf, 'raw', 'BGRX', 0, 1)
+        return self.tset.parseImageIds(utils.trim(shot))
+
+def measure(name, path):
+    """
+    Runs 'frames' frames after a warm up. Returns the KB of fresh pages touched per frame.
+    """
+    for f in xrange(20):
+        redraw(f)
+        path.frame()
+    path.tset.flush()
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    start = time.time()
+    for f in xrange(frames):
+        redraw(f)
+        path.frame()
+    elapsed = time.time() - start
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+    kb = faults * resource.getpagesize() / 1024.0 / frames
+    print("%-6s %6.2f ms per frame \t%8.1f KB allocated per frame" % (name, elapsed / frames * 1000, kb))
+    return kb
+
+with scratchDir():
+    arrayPath = ArrayPath()
+    dirtyPath = DirtyPath()
+    pilPath = PilPath()
+    #All paths give the same ids, and trimming gives a view of the capture buffer
+    for f in xrange(5):
+        redraw(f)
+        ids = arrayPath.frame()
+        assert (ids == pilPath.frame()).all(), "PIL path gives different tile ids"
+        assert (ids == dirtyPath.frame()).all(), "Dirty path gives different tile ids"
+    assert numpy.may_share_memory(utils.trimArray(rgb, arrayPath.box), buf)
+    assert arrayPath.box == (border, border, border + tiles_x * tile_x, border + tiles_y * tile_y)
+
+    frameKb = buf.nbytes / 1024.0
+    print("%dx%d tiles, %d changed per frame, capture buffer %0.0f KB" % (tiles_x, tiles_y, changedPerFrame, frameKb))
+    pilKb = measure("PIL", pilPath)
+    arrayKb = measure("array", arrayPath)
+    #Damage keeps adding up until the dirty path reads it, so it has seen every change
+    measure("dirty", dirtyPath)
+    redraw(0)
+    assert (arrayPath.frame() == dirtyPath.frame()).all(), "Dirty path missed a change"
+    #A frame sized allocation would be hundreds of KB. Allow a few pages for the heap growing.
+    assert arrayKb < 16, "array path allocated %0.1f KB per frame" % arrayKb
+    print("No large allocations per frame on the array path.")
@@ -0,0 +1,91 @@
+#
+# Captures a window while another window covers it: Composite against plain shared memory capture.
+# Needs an X server with MIT-SHM and Composite. Under Xvfb:
+#   Xvfb :99 -screen 0 1600x1000x24 +extension Composite &
+#   DISPLAY=:99 python test/compositeCaptureTest.py
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util import xcapture
+
+from Xlib import display, X
+
+WIDTH = 640
+HEIGHT = 400
+FRAMES = 200
+
+def draw(disp, win, width, height, pattern):
+    """
+    Fills a window with 16x16 tiles, or one colour if 'pattern' is False.
+    """
+    gc = win.create_gc()
+    for ty in xrange(0, height, 16):
+        for tx in xrange(0, width, 16):
+            gc.change(foreground = ((tx * 7919 + ty * 104729) & 0xFFFFFF) if pattern else 0x3050A0)
+            win.fill_rectangle(gc, tx, ty, 16, 16)
+    disp.sync()
+
+def makeWindow(disp, x, y, width, height, pattern):
+    """
+    Maps a window and returns it once it is drawn.
+    """
+    screen = disp.screen()
+    win = screen.root.create_window(x, y, width, height, 0, screen.root_depth, X.InputOutput, X.CopyFromParent,
+                                    background_pixel = screen.black_pixel, event_mask = X.ExposureMask,
+                                    override_redirect = True)
+    win.map()
+    while disp.next_event().type != X.Expose:
+        pass
+    draw(disp, win, width, height, pattern)
+    return win
+
+disp = display.Display()
+win = makeWindow(disp, 0, 0, WIDTH, HEIGHT, True)
+focus = disp.get_input_focus().focus
+
+shm = xcapture.ShmCapture(win.id)
+expected = shm.grab().copy()
+
+#Cover the middle of the window. Without Composite, the covered part reads as the covering window,
+#so shared memory capture skips the frame.
+cover = makeWindow(disp, WIDTH / 4, HEIGHT / 4, WIDTH / 2, HEIGHT / 2, False)
+time.sleep(0.1)
+assert shm.grab() is None, "Shared memory capture should skip a covered window"
+shm.readsScreen = False
+covered = (shm.grab()[..., :3] != expected[..., :3]).any(axis = 2).mean()
+print("Shared memory capture: skipped, %0.0f%% of pixels would be from the covering window" % (covered * 100))
+assert covered > 0.2, "The covering window should show in a plain capture"
+
+#Uncovered parts aren't kept, so draw the window again before redirecting it
+cover.unmap()
+draw(disp, win, WIDTH, HEIGHT, True)
+comp = xcapture.CompositeCapture(win.id)
+#Redirecting keeps the contents
+assert (comp.grab() == expected).all(), "Composite capture differs before covering"
+
+cover.map()
+disp.sync()
+time.sleep(0.1)
+wrong = (comp.grab()[..., :3] != expected[..., :3]).any(axis = 2).mean()
+print("Composite capture: %0.0f%% of pixels differ" % (wrong * 100))
+assert wrong == 0, "Composite capture should see through the covering window"
+assert disp.get_input_focus().focus == focus, "Capturing changed the input focus"
+
+#Resizing gives the window new storage, which has to be picked up
+win.configure(width = WIDTH + 32)
+disp.sync()
+time.sleep(0.1)
+assert comp.grab().shape == (HEIGHT, WIDTH + 32, 4)
+print("Resized window captured at %dx%d" % (WIDTH + 32, HEIGHT))
+
+start = time.time()
+for i in xrange(FRAMES):
+    comp.grab()
+print("Composite capture: %0.1f fps at %dx%d" % (FRAMES / (time.time() - start), WIDTH + 32, HEIGHT))
+
+comp.close()
+shm.close()
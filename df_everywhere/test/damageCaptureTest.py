@@ -0,0 +1,84 @@
+#
+# Damage tracking: only redrawn rows are copied, and nothing at all when the window wasn't drawn to.
+# Needs an X server with MIT-SHM, Composite and DAMAGE. Under Xvfb:
+#   Xvfb :99 -screen 0 1600x1000x24 +extension Composite &
+#   DISPLAY=:99 python test/damageCaptureTest.py
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util import xcapture
+
+from Xlib import display, X
+
+WIDTH = 1280
+HEIGHT = 800
+FRAMES = 200
+
+disp = display.Display()
+screen = disp.screen()
+win = screen.root.create_window(0, 0, WIDTH, HEIGHT, 0, screen.root_depth, X.InputOutput, X.CopyFromParent,
+                                background_pixel = screen.black_pixel, event_mask = X.ExposureMask)
+win.map()
+while disp.next_event().type != X.Expose:
+    pass
+gc = win.create_gc()
+
+def drawTile(x, y, colour):
+    gc.change(foreground = colour)
+    win.fill_rectangle(gc, x * 16, y * 16, 16, 16)
+    disp.sync()
+
+def waitForDamage(capture):
+    """
+    Waits for the X server to report the drawing.
+    """
+    for i in xrange(100):
+        capture.readEvents()
+        if capture.damaged:
+            return
+        time.sleep(0.01)
+    raise AssertionError("No damage reported")
+
+capture = xcapture.DamageCapture(win.id)
+full = xcapture.ShmCapture(win.id)
+capture.grab()
+assert capture.dirty is None, "First grab copies the whole window"
+
+drawTile(10, 20, 0xFF8000)
+waitForDamage(capture)
+frame = capture.grab()
+print("Damaged: %s" % capture.dirty)
+assert capture.dirty and all(y <= 20 * 16 and y + h >= 21 * 16 for x, y, w, h in capture.dirty)
+assert (frame[..., :3] == full.grab()[..., :3]).all(), "Damaged rows weren't copied"
+
+#Nothing drawn: no copy at all
+capture.readEvents()
+assert not capture.damaged
+start = time.time()
+for i in xrange(FRAMES):
+    capture.grab()
+    assert capture.dirty == []
+idle = (time.time() - start) / FRAMES
+print("Undamaged grab: %0.1f us" % (idle * 1e6))
+
+def timeGrabs(grab, tilesPerFrame):
+    start = time.time()
+    for i in xrange(FRAMES):
+        for t in xrange(tilesPerFrame):
+            n = (i * tilesPerFrame + t) * 7919
+            drawTile(n % (WIDTH / 16), n / (WIDTH / 16) % (HEIGHT / 16), n & 0xFFFFFF)
+        grab()
+    return FRAMES / (time.time() - start)
+
+composite = xcapture.CompositeCapture(win.id)
+for tilesPerFrame in [1, 10, 50]:
+    print("%2d tiles drawn per frame: \twhole window %6.1f fps \tdamaged rows %6.1f fps" % (tilesPerFrame,
+        timeGrabs(composite.grab, tilesPerFrame), timeGrabs(capture.grab, tilesPerFrame)))
+
+capture.close()
+composite.close()
+full.close()
@@ -0,0 +1,44 @@
+#
+# Near match hit rate and lookup cost against tileset size.
+#
+
+import time
+import numpy
+
+from testHelpers import scratchDir, glyphTiles
+from util import tileset
+
+tile_x = 16
+tile_y = 16
+threshold = 8
+queries = 500
+
+with scratchDir():
+    for tileCount in [1000, 5000, 20000]:
+        rand = numpy.random.RandomState(0)
+        tiles = glyphTiles(rand, tileCount, tile_x, tile_y)
+        tset = tileset.Tileset(None, tile_x, tile_y, array = True, fuzzy = threshold)
+        tset._appendTiles(tiles, tset._tileKeys(tiles))
+        #Build the signatures up front so they aren't part of the first lookup
+        tset._updateSignatures()
+
+        #Known tiles with a little noise, like gamma or anti-aliasing changes
+        picked = tiles[rand.randint(0, tileCount, queries)]
+        noise = rand.randint(-threshold / 2, threshold / 2 + 1, picked.shape)
+        nearTiles = numpy.clip(picked + noise, 0, 255).astype('uint8')
+        #Tiles that shouldn't match anything
+        newTiles = glyphTiles(rand, queries, tile_x, tile_y)
+
+        start = time.time()
+        nearIds = tset._nearestTiles(nearTiles)
+        nearTime = time.time() - start
+        start = time.time()
+        newIds = tset._nearestTiles(newTiles)
+        newTime = time.time() - start
+
+        print("%6d tiles: \tnoisy hit rate %5.1f%% \t%0.3f ms per tile \tnew tile false hits %5.1f%% \t%0.3f ms per tile" % (tileCount,
+            (nearIds >= 0).mean() * 100, nearTime * 1000 / queries,
+            (newIds >= 0).mean() * 100, newTime * 1000 / queries))
+        #Compared by pixels: tiles with the same foreground and background colour are duplicates
+        assert (nearIds >= 0).all() and (tiles[nearIds] == picked).all(), "Noisy copies of known tiles weren't matched to them"
+        assert (newIds < 0).all(), "New tiles were matched to known ones"
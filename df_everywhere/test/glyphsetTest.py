@@ -0,0 +1,91 @@
+#
+# Checks that glyph, foreground and background maps rebuild the screen exactly, with tiles that aren't
+# two colours going to the fallback tileset, after a partial update, and through the binary map encoding.
+#
+
+try:
+    import Image
+except:
+    from PIL import Image
+
+import numpy
+
+from testHelpers import scratchDir, glyphTiles
+from util import tileset, glyphset, mapframes
+
+tile_x = 16
+tile_y = 16
+tiles_x = 40
+tiles_y = 25
+glyphCount = 200
+otherCount = 20
+
+def makeScreen(tiles, choice):
+    """
+    Lays out tiles by id into a screen array.
+    """
+    return tiles[choice].swapaxes(1, 2).reshape(tiles_y * tile_y, tiles_x * tile_x, 3)
+
+def rebuild(gset, planes):
+    """
+    Draws the screen back from the three maps, the way a viewer does.
+    """
+    palette = numpy.array(gset.palette, dtype = numpy.uint8)
+    fallback = numpy.asarray(gset.tileset.getImage())
+    fallback = gset.tileset._tileBlocks(fallback, tileset._atlasWidth, fallback.shape[0] / tile_y).reshape(-1, tile_y, tile_x, 3)
+    glyph, fg, bg = planes.reshape(3, -1)
+    out = numpy.empty((tiles_y * tiles_x, tile_y, tile_x, 3), dtype = numpy.uint8)
+    for i in xrange(len(out)):
+        if glyph[i] >= 0:
+            mask = gset.glyphs[glyph[i]][..., numpy.newaxis]
+            out[i] = numpy.where(mask, palette[fg[i]], palette[bg[i]])
+        else:
+            out[i] = fallback[fg[i]]
+    return out.reshape(tiles_y, tiles_x, tile_y, tile_x, 3).swapaxes(1, 2).reshape(tiles_y * tile_y, tiles_x * tile_x, 3)
+
+with scratchDir():
+    rand = numpy.random.RandomState(0)
+    #Two colour glyphs, and a few noisy tiles like a graphics set
+    tiles = numpy.concatenate((glyphTiles(rand, glyphCount, tile_x, tile_y),
+                               (rand.rand(otherCount, tile_y, tile_x, 3) * 255).astype('uint8')))
+    choice = rand.randint(0, len(tiles), size = (tiles_y, tiles_x))
+    screen = makeScreen(tiles, choice)
+
+    gset = glyphset.Glyphset(tileset.Tileset(None, tile_x, tile_y, array = True))
+    planes = gset.parseImageIds(screen)
+    assert planes.shape == (3, tiles_y, tiles_x)
+    assert (rebuild(gset, planes) == screen).all(), "Maps don't rebuild the screen"
+    other = planes[0] < 0
+    assert (other == (choice >= glyphCount)).all(), "Only tiles that aren't two colours should fall back"
+    assert (planes[2][other] == -1).all()
+    print("%d glyphs, %d colours, %d fallback tiles rebuild the screen." % (len(gset.glyphs), len(gset.palette), gset.tileset.tileCount))
+
+    #The PIL path gives the same maps
+    pilSet = glyphset.Glyphset(tileset.Tileset(None, tile_x, tile_y, array = True))
+    assert (pilSet.parseImageIds(Image.fromarray(screen)) == planes).all(), "PIL path gives different maps"
+
+    #Redraw a few tiles, one of them a new tile that isn't two colours
+    newTile = (rand.rand(1, tile_y, tile_x, 3) * 255).astype('uint8')
+    tiles = numpy.concatenate((tiles, newTile))
+    before = choice.copy()
+    spots = [(3, 7), (10, 0), (24, 39)]
+    for n, (y, x) in enumerate(spots):
+        choice[y, x] = [5, glyphCount + 1, len(tiles) - 1][n]
+    screen = makeScreen(tiles, choice)
+    dirty = [(x * tile_x, y * tile_y, tile_x, tile_y) for y, x in spots]
+    updated = gset.parseImageIds(screen, dirty)
+    assert gset.frameChanged
+    assert (rebuild(gset, updated) == screen).all(), "Partial update doesn't rebuild the screen"
+    changed = (updated != planes).any(axis = 0)
+    assert not changed[choice == before].any(), "Tiles outside the update changed"
+    print("Partial update of %d tiles rebuilds the screen." % len(spots))
+
+    #Binary maps keep all three planes, and -1 for fallback tiles
+    frame = mapframes.unpack(mapframes.packMap(updated, gset.version, 2))
+    assert frame['shape'] == (3, tiles_y, tiles_x) and (frame['map'] == updated).all(), "Packed map differs"
+    positions = numpy.flatnonzero(updated.ravel() != planes.ravel())
+    frame = mapframes.unpack(mapframes.packChanges(updated.shape, positions, updated.ravel()[positions], gset.version, 2, 1))
+    patched = planes.copy()
+    patched.ravel()[frame['changes'][0]] = frame['changes'][1]
+    assert (patched == updated).all(), "Packed changes differ"
+    print("Glyph maps and changes survive packing.")
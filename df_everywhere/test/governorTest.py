@@ -0,0 +1,46 @@
+#
+# Overhead of the CPU governor, and how close it keeps a busy capture loop to its budget.
+#
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util import governor
+
+def burn(seconds):
+    """
+    Uses CPU like a screen grab and parse.
+    """
+    end = governor.cpuTime() + seconds
+    while governor.cpuTime() < end:
+        sum(xrange(1000))
+
+gov = governor.CpuGovernor()
+frame = min(timeit.Timer(gov.frame).repeat(5, 10000)) / 10000
+update = min(timeit.Timer(gov.update).repeat(5, 1000)) / 1000
+print("frame(): %0.2f us \tupdate(): %0.2f us, run once a second" % (frame * 1e6, update * 1e6))
+
+for budget in [0.25, 0.5]:
+    for cost in [0.005, 0.02]:
+        gov = governor.CpuGovernor(budget = budget)
+        start = lastUpdate = time.time()
+        frames = 0
+        settled = None
+        while time.time() - start < 8:
+            burn(cost)
+            gov.frame()
+            frames += 1
+            time.sleep(gov.delay)
+            if time.time() - lastUpdate >= 1:
+                gov.update()
+                lastUpdate = time.time()
+                if settled is None and lastUpdate - start >= 3:
+                    #Let it settle, then measure
+                    settled = (lastUpdate, governor.cpuTime(), frames)
+        usedWall = time.time() - settled[0]
+        usedCpu = governor.cpuTime() - settled[1]
+        print("budget %d%%, %2d ms per frame: \tused %4.1f%% of a core \t%5.1f frames per second" % (budget * 100, cost * 1000,
+            usedCpu / usedWall * 100, (frames - settled[2]) / usedWall))
@@ -0,0 +1,73 @@
+#
+# Bytes per frame and encode time of binary maps against the JSON lists sent now.
+#
+
+import base64
+import json
+import os
+import sys
+import timeit
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util import mapframes
+
+def makeMap(tiles_x, tiles_y, seed = 0):
+    """
+    Fortress-like map: rooms of floor, walls, blank areas and a few scattered items.
+    """
+    rand = numpy.random.RandomState(seed)
+    #Blank, rock and soil to start with
+    ids = rand.choice([0, 1, 2], size = (tiles_y, tiles_x), p = [0.6, 0.3, 0.1])
+    ids = numpy.repeat(ids[:, ::8], 8, axis = 1)[:, :tiles_x]
+    for i in xrange(tiles_x * tiles_y / 200):
+        x, y = rand.randint(0, tiles_x - 8), rand.randint(0, tiles_y - 6)
+        w, h = rand.randint(3, 8), rand.randint(3, 6)
+        ids[y:y + h, x:x + w] = 3 + rand.randint(0, 4)
+    #Items, creatures and menu text
+    scatter = rand.rand(tiles_y, tiles_x) < 0.05
+    ids[scatter] = rand.randint(10, 400, size = scatter.sum())
+    ids[:, -30:] = rand.randint(400, 500, size = (tiles_y, 30))
+    return ids
+
+def timeMs(f):
+    return min(timeit.Timer(f).repeat(5, 20)) / 20 * 1000
+
+for tiles_x, tiles_y in [(80, 25), (160, 60), (240, 90)]:
+    ids = makeMap(tiles_x, tiles_y)
+
+    jsonBytes = len(json.dumps(ids.tolist()))
+    raw = mapframes.packMap(ids, 7, 1, runs = False)
+    runs = mapframes.packMap(ids, 7, 1)
+
+    for data in [raw, runs]:
+        frame = mapframes.unpack(data)
+        if (frame['map'] != ids).any() or frame['version'] != 7 or frame['seq'] != 1:
+            print("Decoded map differs at %dx%d!" % (tiles_x, tiles_y))
+
+    jsonTime = timeMs(lambda: json.dumps(ids.tolist()))
+    rawTime = timeMs(lambda: mapframes.packMap(ids, 7, 1, runs = False))
+    runsTime = timeMs(lambda: mapframes.packMap(ids, 7, 1))
+
+    print("%dx%d tiles: \tjson %6d bytes %0.2f ms \tuint16 %6d bytes %0.3f ms \truns %6d bytes (%d as base64) %0.3f ms" % (tiles_x, tiles_y,
+        jsonBytes, jsonTime, len(raw), rawTime, len(runs), len(base64.b64encode(runs)), runsTime))
+
+#Deltas between two frames
+ids = makeMap(160, 60)
+moved = ids.copy()
+moved.ravel()[numpy.random.RandomState(1).randint(0, ids.size, 200)] = 5
+changed = numpy.flatnonzero(moved.ravel() != ids.ravel())
+data = mapframes.packChanges(moved.shape, changed, moved.ravel()[changed], 7, 2, 1)
+frame = mapframes.unpack(data)
+rebuilt = ids.copy()
+rebuilt.ravel()[frame['changes'][0]] = frame['changes'][1]
+if (rebuilt != moved).any() or frame['base'] != 1:
+    print("Decoded delta differs!")
+print("\n160x60 tiles, %d changed: \tjson %d bytes \tbinary delta %d bytes" % (len(changed),
+    len(json.dumps(numpy.column_stack((changed, moved.ravel()[changed])).ravel().tolist())), len(data)))
+
+#-1 for new tiles, and more tiles than fit in a uint16
+wide = ids.copy()
+wide[0, :3] = [-1, 70000, 0xFFFF]
+if (mapframes.unpack(mapframes.packMap(wide, 7, 3))['map'] != wide).any():
+    print("Decoded wide map differs!")
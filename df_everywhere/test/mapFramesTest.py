@@ -0,0 +1,59 @@
+#
+# Compares the size of full map events against keyframes and deltas.
+#
+
+import json
+import os
+import sys
+import time
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util import mapframes
+
+tiles_x = 160
+tiles_y = 60
+frames = 200
+
+def applyFrame(current, frame):
+    """
+    What a viewer does with a map event. Returns the new map, or None if a frame was missed.
+    """
+    if 'map' in frame:
+        return numpy.array(frame['map'])
+    if current is None or frame['base'] != applyFrame.last:
+        return None
+    current = current.copy()
+    changes = numpy.array(frame['changes']).reshape(-1, 2)
+    current.ravel()[changes[:, 0]] = changes[:, 1]
+    return current
+
+for fraction in [0.01, 0.05, 0.20]:
+    rand = numpy.random.RandomState(0)
+    ids = rand.randint(0, 400, size = (tiles_y, tiles_x))
+    encoder = mapframes.MapFrames()
+
+    fullBytes = 0
+    deltaBytes = 0
+    encodeTime = 0.0
+    viewer = None
+    applyFrame.last = None
+    for i in xrange(frames):
+        #A few tiles change each frame
+        changed = rand.rand(tiles_y, tiles_x) < fraction
+        ids = numpy.where(changed, rand.randint(0, 400, size = ids.shape), ids)
+
+        fullBytes += len(json.dumps(ids.tolist()))
+        start = time.time()
+        frame = encoder.encode(ids)
+        encodeTime += time.time() - start
+        deltaBytes += len(json.dumps(frame))
+
+        viewer = applyFrame(viewer, frame)
+        applyFrame.last = frame['seq']
+        if viewer is None or (viewer != ids).any():
+            print("Viewer map differs at frame %d!" % i)
+            break
+
+    print("%2d%% changed: \tfull %6d bytes/frame \tdelta %6d bytes/frame \t%0.1fx smaller \tencode %0.2f ms" % (fraction * 100,
+        fullBytes / frames, deltaBytes / frames, float(fullBytes) / deltaBytes, encodeTime * 1000 / frames))
@@ -0,0 +1,86 @@
+#
+# Benchmarks Tileset.parseImageArray against the old tile by tile loop.
+#
+
+try:
+    import Image
+except:
+    from PIL import Image
+
+import time
+import timeit
+import numpy
+
+from testHelpers import scratchDir
+from util import tileset
+
+tile_x = 16
+tile_y = 16
+uniqueTiles = 300
+
+def makeFrame(tiles_x, tiles_y, seed = 0):
+    """
+    Builds a fake screen from a few hundred random tiles.
+    """
+    rand = numpy.random.RandomState(seed)
+    tiles = (rand.rand(uniqueTiles, tile_y, tile_x, 3) * 255).astype('uint8')
+    choice = rand.randint(0, uniqueTiles, size = (tiles_y, tiles_x))
+    frame = tiles[choice].swapaxes(1, 2).reshape(tiles_y * tile_y, tiles_x * tile_x, 3)
+    return Image.fromarray(frame)
+
+def oldParse(tset, img):
+    """
+    The previous parseImageArray loop: one hash and dict lookup per tile.
+    """
+    img_arr = numpy.array(img)
+    image_x, image_y = img.size
+    tiles_x = image_x / tset.tile_x
+
+    sz = img_arr.itemsize
+    h,w = image_y, image_x
+    bh,bw = tset.tile_y, tset.tile_x
+    shape = numpy.array([h/bh, w/bw, bh, bw, 3])
+    strides = sz*numpy.array([w*bh*3,bw*3,w*3,3,1])
+    blocks=numpy.lib.stride_tricks.as_strided(img_arr, shape=shape, strides=strides)
+    a = blocks.reshape([-1,tset.tile_y,tset.tile_x,3])
+
+    tileMap = []
+    row = []
+    for c in a:
+        row.append(oldDict.get(hash(c.tostring()), -1))
+        if len(row) == tiles_x:
+            tileMap.append(row)
+            row = []
+    return tileMap
+
+def newParse(tset, img):
+    """
+    parseImageArray with the previous frame forgotten, so every tile is fingerprinted.
+    """
+    tset._prevFrame = None
+    return tset.parseImageArray(img)
+
+with scratchDir():
+    for tiles_x, tiles_y in [(80, 25), (160, 60), (240, 90)]:
+        img = makeFrame(tiles_x, tiles_y)
+        tset = tileset.Tileset(None, tile_x, tile_y, array = True)
+        #First parse learns the tiles
+        start = time.time()
+        tset.parseImageArray(img)
+        tset.flush()
+        print("%dx%d tiles: \tlearned %d tiles from a cold start in %0.2f ms" % (tiles_x, tiles_y, tset.tileCount, (time.time() - start) * 1000))
+
+        #Same ids, keyed the old way
+        atlas = numpy.array(tset.getImage())
+        oldDict = {}
+        for t in xrange(tset.tileCount):
+            y, x = t / 32 * tile_y, t % 32 * tile_x
+            oldDict[hash(atlas[y:y + tile_y, x:x + tile_x].tostring())] = t
+
+        assert oldParse(tset, img) == newParse(tset, img), "Tile maps differ at %dx%d" % (tiles_x, tiles_y)
+
+        old = min(timeit.Timer(lambda: oldParse(tset, img)).repeat(5, 5)) / 5
+        new = min(timeit.Timer(lambda: newParse(tset, img)).repeat(5, 5)) / 5
+        #Unchanged frame, nothing is fingerprinted
+        same = min(timeit.Timer(lambda: tset.parseImageArray(img)).repeat(5, 5)) / 5
+        print("%dx%d tiles: \told %0.2f ms \tnew %0.2f ms \t%0.1fx \tunchanged %0.2f ms" % (tiles_x, tiles_y, old * 1000, new * 1000, old / new, same * 1000))
@@ -0,0 +1,124 @@
+#
+# Frames per second and memory allocated per frame: MIT-SHM capture against the Gtk path.
+# Needs an X server with MIT-SHM. Under Xvfb:
+#   Xvfb :99 -screen 0 1600x1000x24 &
+#   DISPLAY=:99 python test/shmCaptureTest.py
+# A window with a test pattern is made to capture, so Dwarf Fortress doesn't need to be running.
+#
+
+import ctypes
+import ctypes.util
+import os
+import resource
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util import xcapture
+
+from Xlib import display, X
+
+#Allocations over 128 KB always get fresh pages, so page faults count the memory a frame allocates
+libc = ctypes.CDLL(ctypes.util.find_library('c'))
+M_MMAP_THRESHOLD = -3
+libc.mallopt(M_MMAP_THRESHOLD, 128 * 1024)
+
+WIDTH = 1280
+HEIGHT = 800
+FRAMES = 200
+
+def makeWindow(disp):
+    """
+    Maps a window with a test pattern. Returns it once it is drawn.
+    """
+    screen = disp.screen()
+    win = screen.root.create_window(0, 0, WIDTH, HEIGHT, 0, screen.root_depth, X.InputOutput, X.CopyFromParent,
+                                    background_pixel = screen.black_pixel, event_mask = X.ExposureMask)
+    win.set_wm_name("Dwarf Fortress")
+    win.map()
+    while disp.next_event().type != X.Expose:
+        pass
+    gc = win.create_gc()
+    #16x16 tiles of different colours, like a tileset
+    for y in xrange(0, HEIGHT, 16):
+        for x in xrange(0, WIDTH, 16):
+            gc.change(foreground = (x * 7919 + y * 104729) & 0xFFFFFF)
+            win.fill_rectangle(gc, x, y, 16, 16)
+    disp.sync()
+    return win
+
+def measure(name, grab):
+    """
+    Prints frames per second and kilobytes of new pages per frame.
+    """
+    for i in xrange(10):
+        grab()
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    start = time.time()
+    for i in xrange(FRAMES):
+        grab()
+    elapsed = time.time() - start
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+    print("%-28s %6.1f fps \t%7.1f KB allocated per frame" % (name, FRAMES / elapsed, faults * resource.getpagesize() / 1024.0 / FRAMES))
+
+disp = display.Display()
+win = makeWindow(disp)
+xid = xcapture.findWindow("Dwarf Fortress", exact = True, disp = disp)
+print("Window 0x%x, %dx%d" % (xid, WIDTH, HEIGHT))
+
+capture = xcapture.ShmCapture(xid)
+frame = capture.grab()
+assert frame.shape == (HEIGHT, WIDTH, 4)
+assert capture.grab() is frame, "The same buffer should be returned every frame"
+rgb = numpy.asarray(capture.screenshot())
+assert (rgb == capture.rgb).all(), "PIL image and RGB view differ"
+
+#Capturing leaves the process's X error handler, which Gtk owns, as it was
+x11 = ctypes.CDLL(ctypes.util.find_library('X11'))
+x11.XSetErrorHandler.argtypes = [ctypes.c_void_p]
+x11.XSetErrorHandler.restype = ctypes.c_void_p
+otherHandler = xcapture._XErrorHandler(lambda dpy, event: 0)
+previous = x11.XSetErrorHandler(ctypes.cast(otherHandler, ctypes.c_void_p))
+capture.grab()
+assert x11.XSetErrorHandler(previous) == ctypes.cast(otherHandler, ctypes.c_void_p).value, "X error handler was replaced"
+
+#Nothing is grabbed while another window covers part of this one
+def grabsUntil(test):
+    for i in xrange(100):
+        if test(capture.grab()):
+            return
+        time.sleep(0.02)
+    raise AssertionError("Covering window not picked up")
+
+screen = disp.screen()
+cover = screen.root.create_window(WIDTH / 4, HEIGHT / 4, WIDTH / 2, HEIGHT / 2, 0, screen.root_depth, X.InputOutput,
+                                  X.CopyFromParent, background_pixel = 0, override_redirect = True)
+cover.map()
+disp.sync()
+grabsUntil(lambda frame: frame is None)
+cover.destroy()
+disp.sync()
+grabsUntil(lambda frame: frame is not None)
+print("Frames are skipped while the window is covered.")
+
+measure("shm grab (numpy view)", capture.grab)
+measure("shm grab + PIL image", capture.screenshot)
+measure("shm grab + numpy.array(PIL)", lambda: numpy.array(capture.screenshot()))
+
+try:
+    import gtk, wnck
+    from util import utils
+    while gtk.events_pending():
+        gtk.main_iteration(False)
+    wnckWin = wnck.window_get(xid)
+except ImportError:
+    wnckWin = None
+if wnckWin is not None:
+    measure("gtk linux_screenshot", lambda: utils.linux_screenshot(wnckWin))
+    measure("gtk + numpy.array(PIL)", lambda: numpy.array(utils.linux_screenshot(wnckWin)))
+else:
+    print("pygtk and wnck aren't installed, skipping the Gtk path.")
+
+capture.close()
@@ -0,0 +1,40 @@
+#
+# Setup shared by the tileset test scripts.
+#
+
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy
+
+#Scripts that import this can import util
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+@contextlib.contextmanager
+def scratchDir():
+    """
+    Runs the block in an empty scratch directory with a tilesets/ folder, since Tileset writes to ./tilesets/.
+    The directory is removed afterwards.
+    """
+    workDir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(workDir, 'tilesets'))
+    oldDir = os.getcwd()
+    os.chdir(workDir)
+    try:
+        yield workDir
+    finally:
+        os.chdir(oldDir)
+        shutil.rmtree(workDir)
+
+def glyphTiles(rand, count, tile_x, tile_y):
+    """
+    Glyph shaped tiles in a few colours, like a real tileset. Returns a (count, tile_y, tile_x, 3) array.
+    """
+    palette = (rand.rand(16, 3) * 255).astype('uint8')
+    glyphs = rand.rand(count, tile_y, tile_x, 1) > 0.6
+    fg = palette[rand.randint(0, 16, count)][:, numpy.newaxis, numpy.newaxis]
+    bg = palette[rand.randint(0, 16, count)][:, numpy.newaxis, numpy.newaxis]
+    return numpy.where(glyphs, fg, bg).astype('uint8')
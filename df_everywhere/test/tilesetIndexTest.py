@@ -0,0 +1,96 @@
+#
+# Times loading a large tileset with and without its saved index, and checks that a bad index is ignored
+# and written again, and that saving a bigger tileset removes the one it replaces.
+#
+
+import hashlib
+import os
+import time
+import numpy
+
+from testHelpers import scratchDir, glyphTiles
+from util import tileset
+
+tile_x = 16
+tile_y = 16
+tileCount = 10000
+
+def timedLoad(filename):
+    """
+    Returns a freshly loaded tileset and the ms it took. Waits for an index it writes afterwards.
+    """
+    start = time.time()
+    tset = tileset.Tileset(filename, tile_x, tile_y, array = True)
+    elapsed = (time.time() - start) * 1000
+    tset.flush()
+    return tset, elapsed
+
+with scratchDir():
+    rand = numpy.random.RandomState(0)
+    tiles = glyphTiles(rand, tileCount, tile_x, tile_y)
+    #Make sure every tile is different
+    tiles[:, 0, 0, 0] = numpy.arange(tileCount) % 256
+    tiles[:, 0, 0, 1] = numpy.arange(tileCount) / 256
+
+    tset = tileset.Tileset(None, tile_x, tile_y, array = True)
+    tset._appendTiles(tiles, tset._tileKeys(tiles))
+    tset._saveSet()
+    tset.flush()
+    filename = tset.filename
+
+    indexFile = os.path.join('tilesets', tileset._indexFilename(filename))
+    with open(os.path.join('tilesets', filename), 'rb') as f:
+        checksum = hashlib.md5(f.read()).digest()
+    print("\nTileset png %d KB, index %d KB" % (os.path.getsize(os.path.join('tilesets', filename)) / 1024, os.path.getsize(indexFile) / 1024))
+
+    #The parts the index replaces
+    start = time.time()
+    img = tileset.Image.open(os.path.join('tilesets', filename))
+    img.load()
+    print("Decoding the png: \t%0.1f ms" % ((time.time() - start) * 1000))
+    start = time.time()
+    tset._tileKeys(tiles)
+    print("Fingerprinting %d tiles: \t%0.1f ms" % (tileCount, (time.time() - start) * 1000))
+    start = time.time()
+    assert tileset._readIndex(indexFile, checksum, tile_x, tile_y, tileCount) is not None
+    print("Reading index of %d tiles: \t%0.1f ms" % (tileCount, (time.time() - start) * 1000))
+
+    indexed, indexedTime = timedLoad(filename)
+    assert indexed.tileDict == tset.tileDict, "Indexed load gave different tiles"
+    assert (numpy.asarray(indexed.getImage()) == numpy.asarray(tset.getImage())).all(), "Indexed load gave different pixels"
+
+    with open(indexFile, 'rb') as f:
+        good = f.read()
+    ids = tileset._indexHeader.size + 8 * tileCount
+    bad = {
+        'truncated': good[:-100],
+        #Two tiles given the same id
+        'repeated id': good[:ids] + good[ids:ids + 8] * 2 + good[ids + 16:],
+        'unsorted keys': good[:tileset._indexHeader.size] + good[tileset._indexHeader.size + 8:ids] + good[tileset._indexHeader.size:tileset._indexHeader.size + 8] + good[ids:],
+        }
+    for name, data in sorted(bad.items()):
+        with open(indexFile, 'wb') as f:
+            f.write(data)
+        assert tileset._readIndex(indexFile, checksum, tile_x, tile_y, tileCount) is None, "%s index was used" % name
+        loaded, loadTime = timedLoad(filename)
+        assert loaded.tileDict == tset.tileDict, "%s index gave different tiles" % name
+        assert tileset._readIndex(indexFile, checksum, tile_x, tile_y, tileCount) is not None, "%s index wasn't written again" % name
+    print("Truncated and inconsistent indexes are ignored and written again.")
+
+    os.remove(indexFile)
+    hashed, hashedTime = timedLoad(filename)
+    assert hashed.tileDict == tset.tileDict, "Load without index gave different tiles"
+    assert tileset._readIndex(indexFile, checksum, tile_x, tile_y, tileCount) is not None, "Missing index wasn't written"
+    
+    #Learning tiles in batches leaves only the newest image and index
+    for batch in xrange(3):
+        more = tiles[:10].copy()
+        more[:, 1, 1, 0] = batch + 1
+        hashed._appendTiles(more, hashed._tileKeys(more))
+        hashed._saveSet()
+        hashed.flush()
+    assert sorted(os.listdir('tilesets')) == sorted([hashed.filename, tileset._indexFilename(hashed.filename)]), "Old tilesets left behind"
+    print("Superseded tileset images and indexes are removed.")
+
+    print("\nLoad with index: \t%0.1f ms" % indexedTime)
+    print("Load without index: \t%0.1f ms" % hashedTime)
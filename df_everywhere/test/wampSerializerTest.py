@@ -0,0 +1,97 @@
+#
+# Bytes on the wire and CPU time of JSON against binary serializers, through a local router.
+# Publishes a tileset png and binary maps to itself, base64 encoded for JSON and as bytes otherwise.
+#
+
+import base64
+import os
+import sys
+import time
+import numpy
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.endpoints import clientFromString
+
+from autobahn.twisted.wamp import ApplicationSession, ApplicationSessionFactory
+from autobahn.twisted.websocket import WampWebSocketClientFactory
+from autobahn.wamp import types, message
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util import wamp_local, mapframes
+
+port = 7091
+frames = 500
+
+#A 2000 tile tileset and a 160x60 map
+rand = numpy.random.RandomState(0)
+tilesetPng = rand.bytes(150000)
+ids = numpy.repeat(rand.randint(0, 2000, size = (60, 20)), 8, axis = 1)
+mapFrame = mapframes.packMap(ids, 2000, 1)
+
+class Publisher(ApplicationSession):
+    """
+    Publishes the payloads to itself and times the whole run.
+    """
+
+    def onJoin(self, details):
+        #Errors end the run instead of leaving it waiting
+        self.publishAll().addErrback(self.factory.finished.errback)
+
+    @inlineCallbacks
+    def publishAll(self):
+        serializer = self._transport._serializer
+        binary = serializer.SERIALIZER_ID != u"json"
+        png = tilesetPng if binary else base64.b64encode(tilesetPng)
+        frame = mapFrame if binary else base64.b64encode(mapFrame)
+
+        self.received = 0
+        done = Deferred()
+        def onEvent(payload):
+            self.received += 1
+            if self.received == frames + 1:
+                done.callback(None)
+        yield self.subscribe(onEvent, u'df_everywhere.test.map')
+
+        #Bytes per message as the serializer writes it
+        wire = [len(serializer.serialize(message.Publish(1, u'df_everywhere.test.map', args = [p]))[0]) for p in [png, frame]]
+
+        start = time.clock()
+        publish = types.PublishOptions(excludeMe = False)
+        self.publish(u'df_everywhere.test.map', png, options = publish)
+        for i in xrange(frames):
+            self.publish(u'df_everywhere.test.map', frame, options = publish)
+        yield done
+        cpu = time.clock() - start
+
+        print("%-8s \ttileset %6d bytes \tmap %5d bytes \t%d maps in %0.1f ms cpu" % (serializer.SERIALIZER_ID, wire[0], wire[1], frames, cpu * 1000))
+        self.factory.finished.callback(None)
+        self.leave()
+
+@inlineCallbacks
+def run():
+    for serializer in wamp_local.serializers():
+        session_factory = ApplicationSessionFactory(types.ComponentConfig(realm = u"realm1"))
+        session_factory.session = Publisher
+        session_factory.finished = Deferred()
+        transport_factory = WampWebSocketClientFactory(session_factory, "ws://127.0.0.1:%d/ws" % port, serializers = [serializer])
+        clientFromString(reactor, "tcp:127.0.0.1:%d" % port).connect(transport_factory)
+        yield session_factory.finished
+    reactor.stop()
+
+failed = []
+
+def fail(reason):
+    failed.append(reason)
+    print("Failed: %s" % reason)
+    if reactor.running:
+        reactor.stop()
+
+if __name__ == '__main__':
+    wamp_local.wampServ("ws://127.0.0.1:%d/ws" % port, "tcp:%d" % port)
+    reactor.callWhenRunning(lambda: run().addErrback(fail))
+    timeout = reactor.callLater(120, fail, "timed out")
+    reactor.run()
+    if timeout.active():
+        timeout.cancel()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,131 @@
+#
+# Follows a window through resizes and a restart without asking the X server for its geometry each frame.
+# Needs an X server with MIT-SHM and Composite. Under Xvfb:
+#   Xvfb :99 -screen 0 1600x1000x24 +extension Composite &
+#   DISPLAY=:99 python test/windowTrackerTest.py
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util import xcapture
+
+from Xlib import display, X
+
+WIDTH = 640
+HEIGHT = 400
+FRAMES = 200
+TITLE = "Dwarf Fortress"
+
+disp = display.Display()
+
+def makeWindow(width, height):
+    """
+    Maps a titled window and returns it once it is drawn.
+    """
+    #Exposures left over from an earlier window would leave this one unsent. Its id can be the same one.
+    while disp.pending_events():
+        disp.next_event()
+    screen = disp.screen()
+    win = screen.root.create_window(0, 0, width, height, 0, screen.root_depth, X.InputOutput, X.CopyFromParent,
+                                    background_pixel = 0x3050A0, event_mask = X.ExposureMask)
+    win.set_wm_name(TITLE)
+    win.map()
+    while disp.next_event().type != X.Expose:
+        pass
+    return win
+
+def waitFor(capture, test):
+    """
+    Grabs until 'test' is true of the frame.
+    """
+    for i in xrange(100):
+        frame = capture.grab()
+        if test(frame):
+            return frame
+        time.sleep(0.02)
+    raise AssertionError("Window change not picked up")
+
+class CountingDisplay:
+    """
+    Counts the requests that wait for a reply from the X server.
+    """
+    def __init__(self, disp):
+        self.replies = 0
+        send = disp.display.send_and_recv
+        def counted(*args, **kwargs):
+            if kwargs.get('request') is not None:
+                self.replies += 1
+            return send(*args, **kwargs)
+        disp.display.send_and_recv = counted
+
+win = makeWindow(WIDTH, HEIGHT)
+tracker = xcapture.WindowTracker(title = TITLE, exact = True, retryDelay = 0.1)
+assert tracker.window.id == win.id and (tracker.width, tracker.height) == (WIDTH, HEIGHT)
+
+#Covering the window is heard about, for the Gtk path to raise it only then.
+#Checked before capturing, as a window redirected by Composite always counts as uncovered.
+def waitForObscured(obscured):
+    for i in xrange(100):
+        tracker.readEvents()
+        if tracker.obscured == obscured:
+            return
+        time.sleep(0.02)
+    raise AssertionError("Visibility change not picked up")
+
+screen = disp.screen()
+cover = screen.root.create_window(WIDTH / 4, HEIGHT / 4, WIDTH / 2, HEIGHT / 2, 0, screen.root_depth, X.InputOutput,
+                                  X.CopyFromParent, background_pixel = 0, override_redirect = True)
+cover.map()
+disp.sync()
+waitForObscured(True)
+cover.destroy()
+disp.sync()
+waitForObscured(False)
+assert not tracker.composited
+print("Covered and uncovered window seen")
+
+capture = xcapture.CompositeCapture(tracker)
+assert capture.grab().shape == (HEIGHT, WIDTH, 4)
+
+#Frames don't ask about the window
+counter = CountingDisplay(tracker.display)
+start = time.time()
+for i in xrange(FRAMES):
+    capture.grab()
+print("%0.1f fps, %d X replies waited for in %d frames" % (FRAMES / (time.time() - start), counter.replies, FRAMES))
+assert counter.replies == 0, "Window geometry was asked for during capture"
+
+#Resize
+generation = tracker.generation
+win.configure(width = WIDTH + 32, height = HEIGHT - 16)
+disp.sync()
+waitFor(capture, lambda frame: frame is not None and frame.shape == (HEIGHT - 16, WIDTH + 32, 4))
+assert tracker.generation > generation
+print("Resized window captured at %dx%d" % (tracker.width, tracker.height))
+
+#Restart: the window is destroyed and a new one with the same title appears
+win.destroy()
+disp.sync()
+waitFor(capture, lambda frame: frame is None)
+assert tracker.window is None
+win = makeWindow(WIDTH, HEIGHT)
+waitFor(capture, lambda frame: frame is not None and frame.shape == (HEIGHT, WIDTH, 4))
+assert tracker.window.id == win.id and tracker.found == 2
+print("New window 0x%x found after a restart" % win.id)
+
+#Under a compositing manager visibility isn't known, and the Gtk path keeps raising the window
+manager = disp.screen().root.create_window(0, 0, 1, 1, 0, 0)
+manager.set_selection_owner(disp.intern_atom('_NET_WM_CM_S%d' % disp.get_default_screen()), X.CurrentTime)
+disp.sync()
+composited = xcapture.WindowTracker(window = win.id)
+composited.raised()
+assert composited.composited and composited.obscured is None
+composited.close()
+manager.destroy()
+disp.sync()
+
+capture.close()
+tracker.close()
@@ -7,13 +7,17 @@ from twisted.internet import reactor
 
 class ConsoleInput(object):
 
-    def __init__(self, stopFunction, reconnectFunction):
+    def __init__(self, stopFunction, reconnectFunction, statsFunction = None, profileFunction = None):
         self.stopFunction = stopFunction
         self.reconnectFunction = reconnectFunction
+        self.statsFunction = statsFunction
+        self.profileFunction = profileFunction
     
     def start(self):
         self.terminator = 'q'
         self.restart = 'r'
+        self.stats = 't'
+        self.profile = 'p'
         self.getKey = _Getch()
         self.startReceiving()
     def startReceiving(self, s = ''):
@@ -22,6 +26,12 @@ class ConsoleInput(object):
         elif s == self.restart:
             self.reconnectFunction()
             _deferToThread(self.getKey).addCallback(self.startReceiving)
+        elif s == self.stats and self.statsFunction is not None:
+            self.statsFunction()
+            _deferToThread(self.getKey).addCallback(self.startReceiving)
+        elif s == self.profile and self.profileFunction is not None:
+            self.profileFunction()
+            _deferToThread(self.getKey).addCallback(self.startReceiving)
         else:
             _deferToThread(self.getKey).addCallback(self.startReceiving)
                 
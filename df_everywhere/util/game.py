@@ -18,10 +18,43 @@
 #
 # 
 #
+import base64
+import time
+
 from twisted.internet import reactor, threads
 from twisted.internet.defer import inlineCallbacks   
 
-from util import wamp_local, sendInput, utils, prettyConsole
+from util import wamp_local, sendInput, utils, prettyConsole, mapframes, stats, profiler
+
+def _now():
+    """
+    Host time used for latency, in seconds.
+    """
+    return time.time()
+
+class _XEventReader:
+    """
+    Lets the reactor read X events for a capture with damage tracking (xcapture.DamageCapture).
+    'callback' is called when the game window is redrawn.
+    """
+    
+    def __init__(self, capture, callback):
+        self.capture = capture
+        self.callback = callback
+        
+    def fileno(self):
+        return self.capture.fileno()
+        
+    def doRead(self):
+        self.capture.readEvents()
+        if self.capture.damaged:
+            self.callback()
+            
+    def connectionLost(self, reason):
+        prettyConsole.console('log', "Lost the X connection used for window damage.")
+        
+    def logPrefix(self):
+        return 'XDamage'
 
 class Game():
     """
@@ -32,18 +65,64 @@ class Game():
         ### FPS reports
         self.fps = fps
         self.fps_counter = 0
+        self.sent_counter = 0
+        
+        ### CPU budget, see util/governor.py. None to capture as fast as possible.
+        self.governor = None
+        self.governorDelay = 1
         
         ### Tileset
         self.tileset = None
+        self.tilesetVersionSent = None
         
         ### Commands
         self.shotFunction = shotFunction
         self.window_hnd = window_hnd
+        self.arrayFrames = False #shotFunction returns (height, width, 3) arrays instead of PIL images, which are never copied
+        self.trimBox = None #border found by utils.trimBox on the last array frame
+        self.damageCapture = None #capture that reports redrawn areas. Frames are then only grabbed after the game draws.
+        self.damageReader = None
+        self.windowTracker = None #xcapture.WindowTracker following the game window. Frames are skipped while it is gone.
+        self.windowGeneration = None
         self.controlWindow = sendInput.SendInput(self.window_hnd)
+        self.controlGeneration = None #tracker generation that window_hnd and controlWindow were made for
+        self.pendingCommands = [] #[id, client timestamp, time injected] waiting for a changed frame
+        self.commandTimeout = 2.0 #commands that don't change the screen are forgotten after this long
+        self.inputLatency = stats.RollingHistogram() #ms from injecting a command to sending the changed frame
+        
+        ### Totals for util/metrics.py
+        self.framesSent = 0
+        self.framesSkipped = 0
+        self.framesDropped = 0
+        self.commandsReceived = 0
+        self.heartbeatsReceived = 0
+        self.reconnects = 0
+        
+        ### Frame stages, see stats.FrameTracer. Learning new tiles is timed inside hashing.
+        self.tracer = stats.FrameTracer(['capture', 'trim', 'hash', 'learn', 'publish'])
+        
+        ### Sampling profiler, started from the console
+        self.profiler = profiler.SamplingProfiler()
+        self.profileSeconds = 30
         
         ### Timing delays
         self.screenDelay = 0.0
         self.screenDelaySlowed = 0.5
+        self.screenDelayIdle = 0.0 #grows while the screen isn't changing
+        self.commandCaptureDelays = [0.016, 0.05, 0.12] #extra screen grabs after a command, whatever the schedule
+        self.screenDelayIdleMin = 0.02
+        self.screenDelayIdleMax = 0.5
+        self.mapResendDelay = 1.0 #unchanged maps are still sent this often, for viewers that just joined
+        self.mapSentTime = 0
+        
+        ### Backpressure
+        self.mapBufferHigh = 256 * 1024 #bytes waiting to be sent before maps are held back
+        self.mapBufferLow = 32 * 1024 #bytes waiting to be sent before maps are sent again
+        self.drainDelay = 0.05
+        self.mapsBackedUp = False
+        self.pendingMap = None #newest map held back while backed up
+        self.pendingMapChanged = False
+        self.drop_counter = 0
         self.filenameDelay = 5
         self.sizeDelay = 5
         self.heartbeatDelay = 1
@@ -53,6 +132,11 @@ class Game():
         self.web_topic = web_topic
         self.web_key = web_key
         self.topicPrefix = "df_everywhere.%s" % self.web_topic
+        #Published topics, formatted once
+        self.topics = dict((name, "%s.%s" % (self.topicPrefix, name)) for name in ['map', 'tileset', 'tilesetversion', 'tilesize', 'screensize'])
+        self.publishCounts = dict.fromkeys(self.topics, 0)
+        self.publishBytes = dict.fromkeys(self.topics, 0) #as serialized, see _countBytes
+        self.topicNames = dict((topic, name) for name, topic in self.topics.iteritems())
         self.connected = False
         self.connection = None
         self.defereds = {}
@@ -61,7 +145,8 @@ class Game():
         self.retryWaits = 0 #number of cycles program has waited for connection
         self.retryAttempts = 0 #number of retry attempts. Used to increase wait time. 
         self.reconnecting = False
-        self.sendFullMaps = True #whether or not to always send full maps
+        self.sendFullMaps = True #whether or not to always send full maps as lists
+        self.mapFrames = mapframes.MapFrames(keyframeInterval = 100) #keyframes and deltas when not sending full maps
         
         ### Heartbeats
         self.heartbeatCounter = 120
@@ -111,6 +196,7 @@ class Game():
             else:
                 prettyConsole.console('log', "Connected...")
                 self.connected = True
+                wamp_local.countPublishedBytes(self.connection[0], self._countBytes)
                 self.reconnecting = False
                 self.retryWaits = 0
                 self.retryAttempts = 0
@@ -120,12 +206,18 @@ class Game():
                 
                 ### Initialize reactor loops
                 reactor.callLater(self.screenDelay, self._loopScreen)
+                if self.damageCapture is not None:
+                    if self.damageReader is None:
+                        self.damageReader = _XEventReader(self.damageCapture, self._screenDamaged)
+                    reactor.addReader(self.damageReader)
                 reactor.callLater(self.filenameDelay, self._loopFilename)
                 reactor.callLater(self.sizeDelay, self._loopTileSize)
                 reactor.callLater(self.sizeDelay, self._loopScreenSize)
                 reactor.callLater(self.heartbeatDelay, self._loopHeartbeat)
                 if self.fps:
                     reactor.callLater(5, self._loopPrintFps)
+                if self.governor is not None:
+                    reactor.callLater(self.governorDelay, self._loopGovernor)
             
     @inlineCallbacks
     def _registerRPC(self):
@@ -135,6 +227,14 @@ class Game():
         try:
             d = yield self.connection[0].register(self.tileset.wampSend, '%s.tilesetimage' % self.topicPrefix)
             self.rpcs['tileset'] = d
+            d = yield self.connection[0].register(self._sendTilesetDelta, '%s.tilesetdelta' % self.topicPrefix)
+            self.rpcs['tilesetdelta'] = d
+            if self.binaryPayloads():
+                #Png without base64, for viewers on a binary serializer
+                d = yield self.connection[0].register(self.tileset.wampSendRaw, '%s.tilesetraw' % self.topicPrefix)
+                self.rpcs['tilesetraw'] = d
+            d = yield self.connection[0].register(self.mapFrames.requestKeyframe, '%s.keyframe' % self.topicPrefix)
+            self.rpcs['keyframe'] = d
         except Exception as inst:
             prettyConsole.console('log', inst)
             reactor.callLater(1, self.reconnect)
@@ -145,11 +245,42 @@ class Game():
         Subscribes to incomming commands.
         """
         try:
-            d = yield self.connection[0].subscribe(self.controlWindow.receiveCommand, '%s.commands' % self.topicPrefix)
+            d = yield self.connection[0].subscribe(self._receiveCommand, '%s.commands' % self.topicPrefix)
             self.subscriptions['commands'] = d
         except:
             prettyConsole.console('log', 'Command sub error')
     
+    def _receiveCommand(self, command, **tags):
+        """
+        Sends a command to the game window and captures the screen a few times right after.
+        Viewers can tag a command with an 'id' and their own 'time' keyword arguments. Both are sent back
+        with the first changed frame, along with the milliseconds it took on this end.
+        """
+        self.controlWindow.receiveCommand(command)
+        self.commandsReceived += 1
+        commandId = tags.get('id')
+        clientTime = tags.get('time')
+        if commandId is not None:
+            self.pendingCommands.append([commandId, clientTime, _now()])
+        self._wakeScreen()
+        
+        #Show the result as soon as the game draws it, even when slowed or idle.
+        #A newer command restarts the burst.
+        for i, delay in enumerate(self.commandCaptureDelays):
+            burst = self.defereds.get('burst%d' % i)
+            if burst is not None and burst.active():
+                burst.cancel()
+            self.defereds['burst%d' % i] = reactor.callLater(delay, self._captureScreen)
+        
+    def _wakeScreen(self):
+        """
+        Ends any back off and reschedules the next screen grab at the full rate.
+        """
+        self.screenDelayIdle = 0.0
+        screen = self.defereds.get('screen')
+        if screen is not None and screen.active():
+            screen.reset(self._screenDelay())
+            
     @inlineCallbacks
     def _subscribeHeartbeats(self):
         """
@@ -167,6 +298,7 @@ class Game():
         """
         #On hearbeat, reset counter.
         self.heartbeatCounter = 120
+        self.heartbeatsReceived += 1
         if self.slowed:
             prettyConsole.console('log', "Viewer connected. Resuming...")
             self.slowed = False
@@ -192,44 +324,150 @@ class Game():
         """
         Handles periodically running screen grabs.
         """
+        if self._captureScreen():
+            delay = self._screenDelay()
+            if self.damageCapture is not None and not self.damageCapture.damaged:
+                #Nothing to grab until the game draws, see _screenDamaged. Still resend the map now and then.
+                delay = max(delay, self.mapResendDelay)
+            self.defereds['screen'] = reactor.callLater(delay, self._loopScreen)
+            
+    def _screenDamaged(self):
+        """
+        Brings the next screen grab forward when the game window is redrawn.
+        """
+        screen = self.defereds.get('screen')
+        if screen is not None and screen.active():
+            delay = self._screenDelay()
+            if screen.getTime() - reactor.seconds() > delay:
+                screen.reset(delay)
+        
+    def _followWindow(self):
+        """
+        Points window_hnd and controlWindow at the tracker's window once it is found again, resized or remapped.
+        """
+        tracker = self.windowTracker
+        if tracker is None:
+            return
+        tracker.readEvents()
+        if tracker.window is None or tracker.generation == self.controlGeneration:
+            return
+        if self.controlGeneration is not None:
+            window = utils.linux_get_window_byxid(tracker.window.id)
+            if window is None:
+                #Not known to the window manager yet. Try again next frame.
+                return
+            self.window_hnd = window
+            self.controlWindow = sendInput.SendInput(self.window_hnd)
+        self.controlGeneration = tracker.generation
+        
+    def _captureScreen(self):
+        """
+        Grabs, parses and sends the screen. Returns False if the game window is gone.
+        """
+        self.tracer.start()
+        self._followWindow()
         try:
             shot = self.shotFunction(self.window_hnd, debug = False)
+            if shot is None and self.windowTracker is not None and (self.windowTracker.window is None or self.windowTracker.obscured):
+                #The game window closed or is covered. Keep going until it is back.
+                return True
             #Need to check that an image was returned.
-            shot_x, shot_y = shot.size
+            if self.arrayFrames:
+                shot_y, shot_x = shot.shape[:2]
+            else:
+                shot_x, shot_y = shot.size
         except:
             print("Error getting image. Exiting.")
             #reactor.stop()
             self.stopClean()
-            return
+            return False
+        self.tracer.mark('capture')
+        
+        if self.windowTracker is not None and self.windowTracker.generation != self.windowGeneration:
+            #New, resized or remapped window: find the border again
+            self.windowGeneration = self.windowTracker.generation
+            self.trimBox = None
         
-        trimmedShot = utils.trim(shot, debug = False) 
+        #Rectangles redrawn since the last grab, None if anything could have changed
+        dirty = None
+        if self.damageCapture is not None:
+            dirty = self.damageCapture.dirty
+        if self.arrayFrames:
+            #A view into the capture buffer. The border can't move if nothing was redrawn.
+            if dirty != [] or self.trimBox is None:
+                box = utils.trimBox(shot, self.trimBox)
+                if box != self.trimBox:
+                    dirty = None
+                self.trimBox = box
+            trimmedShot = utils.trimArray(shot, self.trimBox) if self.trimBox is not None else None
+            if dirty:
+                left, top = self.trimBox[:2]
+                dirty = [(x - left, y - top, w, h) for x, y, w, h in dirty]
+        else:
+            trimmedShot = utils.trim(shot, debug = False) 
+        self.tracer.mark('trim')
         
+        tileMap = []
+        changed = True
         if trimmedShot is not None:
             
-            #Only send a full tile map every 20 cycles, otherwise just send changes
-            #Is this needed anymore? Javascript expects full maps all the time.
-            #This is slower with deferToThread
-            if self.sendFullMaps or (self.screenCycles) % 20 == 0:
-                tileMap = self.tileset.parseImageArray(trimmedShot, returnFullMap = True)
-                #tileMap = yield threads.deferToThread(self.tileset.parseImageArray, trimmedShot, returnFullMap = True)
+            if self.sendFullMaps:
+                #Javascript viewer expects full maps all the time.
+                tileMap = self.tileset.parseImageArray(trimmedShot, dirty)
+                #tileMap = yield threads.deferToThread(self.tileset.parseImageArray, trimmedShot)
             else:
-                tileMap = self.tileset.parseImageArray(trimmedShot, returnFullMap = False)
-                #tileMap = yield threads.deferToThread(self.tileset.parseImageArray, trimmedShot, returnFullMap = False)
+                ids = self.tileset.parseImageIds(trimmedShot, dirty)
+            changed = self.tileset.frameChanged
         else:
             #If there was an error getting the tilemap, fake one.
             prettyConsole.console('log', "Error reading game window.")
-            tileMap = []
+        self.tracer.mark('hash', inner = ('learn', self.tileset.learnTime if trimmedShot is not None else 0))
         
-        self._sendTileMap(tileMap)
+        #Skip frames that are the same as the last one
+        if changed or time.time() - self.mapSentTime >= self.mapResendDelay:
+            if trimmedShot is not None and not self.sendFullMaps:
+                #Encoded when sent
+                tileMap = ids
+            self._publishMap(tileMap, changed)
+        else:
+            self.framesSkipped += 1
+        if self.tileset.version != self.tilesetVersionSent:
+            #Let viewers know right away that there are new tiles
+            self._sendTilesetVersion()
+        self.tracer.mark('publish')
         self.screenCycles += 1
         
         if self.fps:
             self.fps_counter += 1
+        if self.governor is not None:
+            self.governor.frame()
+            
+        #Back off while the screen is static, back to full rate on the first change
+        if changed:
+            if self.screenDelayIdle == self.screenDelayIdleMax:
+                prettyConsole.console('log', "Screen changed, capturing at full rate.")
+            self.screenDelayIdle = 0.0
+        elif self.screenDelayIdle < self.screenDelayIdleMax:
+            self.screenDelayIdle = min(max(2 * self.screenDelayIdle, self.screenDelayIdleMin), self.screenDelayIdleMax)
+            if self.screenDelayIdle == self.screenDelayIdleMax:
+                prettyConsole.console('log', "Screen static, capturing every %0.2f seconds." % self.screenDelayIdleMax)
+        return True
         
-        if self.slowed:
-            self.defereds['screen'] = reactor.callLater(self.screenDelaySlowed, self._loopScreen)
-        else:
-            self.defereds['screen'] = reactor.callLater(self.screenDelay, self._loopScreen)
+    def _screenDelay(self):
+        """
+        Returns the delay until the next screen grab.
+        """
+        delay = self.screenDelaySlowed if self.slowed else self.screenDelay
+        if self.governor is not None:
+            delay = max(delay, self.governor.delay)
+        return max(delay, self.screenDelayIdle)
+        
+    def _loopGovernor(self):
+        """
+        Handles periodically adjusting the screen grab rate to stay under the CPU budget.
+        """
+        self.governor.update()
+        self.defereds['governor'] = reactor.callLater(self.governorDelay, self._loopGovernor)
         
     def _loopFilename(self):
         """
@@ -238,13 +476,26 @@ class Game():
         if self.connected:
             if self.tileset.filename is not None:
                 try:
-                    self.connection[0].publish("%s.tileset" % self.topicPrefix, self.tileset.filename)
+                    self._publish('tileset', self.tileset.filename)
                 except:
                     #connection lost, reconnect
                     self.reconnect()
+            self._sendTilesetVersion()
                     
         self.defereds['filename'] = reactor.callLater(self.filenameDelay, self._loopFilename)
         
+    def _sendTilesetVersion(self):
+        """
+        Sends the current tileset version. Viewers with this version already don't need to call tilesetimage.
+        """
+        if self.connected:
+            try:
+                self._publish('tilesetversion', self.tileset.version)
+                self.tilesetVersionSent = self.tileset.version
+            except:
+                #connection lost, reconnect
+                reactor.callLater(1, self.reconnect)
+        
     def _loopTileSize(self):
         """
         Handles periodically sending the current tile dimensions.
@@ -252,7 +503,7 @@ class Game():
         if self.connected:
             if (self.tileset.tile_x is not None) and (self.tileset.tile_y is not None):
                 try:
-                    self.connection[0].publish("%s.tilesize" % self.topicPrefix, [self.tileset.tile_x, self.tileset.tile_y])
+                    self._publish('tilesize', [self.tileset.tile_x, self.tileset.tile_y])
                 except:
                     #connection lost, reconnect
                     self.reconnect()
@@ -267,30 +518,189 @@ class Game():
                 #Only send screen size update if it makes sense
                 if (self.tileset.screen_x % self.tileset.tile_x == 0) and (self.tileset.screen_y % self.tileset.tile_y == 0):
                     try:
-                        self.connection[0].publish("%s.screensize" % self.topicPrefix, [self.tileset.screen_x, self.tileset.screen_y])
+                        self._publish('screensize', [self.tileset.screen_x, self.tileset.screen_y])
                     except:
                         #connection lost, reconnect
                         self.reconnect()
         self.defereds['screenSize'] = reactor.callLater(self.sizeDelay, self._loopScreenSize)
         
-    def _sendTileMap(self, tilemap):
+    def _sendTileMap(self, tilemap, commands = None):
         """
-        Sends tilemap over connection.
+        Sends tilemap over connection. 'commands' lists the tagged commands this map is the first to show.
+        Returns True if the map was published.
         """
         if self.connected:
             if tilemap != []:
+                if isinstance(tilemap, str) and not self.binaryPayloads():
+                    #can't send binary data directly over JSON. Base64 encode first.
+                    tilemap = base64.b64encode(tilemap)
                 try:
-                    self.connection[0].publish("%s.map" % self.topicPrefix, tilemap)
+                    if commands:
+                        self._publish('map', tilemap, commands = commands)
+                    else:
+                        self._publish('map', tilemap)
+                    return True
                 except:
                     #connection lost, reconnect
                     reactor.callLater(1, self.reconnect)
+        return False
                 
+    def _publish(self, name, payload, **kwargs):
+        """
+        Publishes to one of self.topics and counts it.
+        """
+        self.connection[0].publish(self.topics[name], payload, **kwargs)
+        self.publishCounts[name] += 1
+        
+    def _countBytes(self, topic, size):
+        """
+        Adds the serialized size of a published message to publishBytes.
+        """
+        name = self.topicNames.get(topic)
+        if name is not None:
+            self.publishBytes[name] += size
+            
+    def _publishMap(self, tileMap, changed = True):
+        """
+        Sends a map, or holds it back while the connection is behind. Only the newest held map is kept.
+        'tileMap' is a list of rows, or an array of ids to be encoded by mapFrames.
+        """
+        if not self.mapsBackedUp and self._bufferedBytes() > self.mapBufferHigh:
+            self.mapsBackedUp = True
+            self.defereds['drain'] = reactor.callLater(self.drainDelay, self._loopDrain)
+            
+        if self.mapsBackedUp:
+            if self.pendingMap is not None:
+                #Superseded by this one
+                self.drop_counter += 1
+                self.framesDropped += 1
+            self.pendingMap = tileMap
+            self.pendingMapChanged = self.pendingMapChanged or changed
+        else:
+            self._sendMap(tileMap, changed)
+            
+    def _sendMap(self, tileMap, changed = True):
+        """
+        Encodes and sends a map.
+        """
+        encoded = not isinstance(tileMap, list)
+        if encoded:
+            #Keyframe every few cycles or when a viewer asks, otherwise just the changes
+            tileMap = self.mapFrames.encode(tileMap, self.tileset.version)
+        commands = self._commandsShown(changed)
+        if not self._sendTileMap(tileMap, commands):
+            #Not published, so not counted. It is tried again by the next frame or resend.
+            if encoded:
+                #Viewers missed these changes
+                self.mapFrames.requestKeyframe()
+            return
+        if commands:
+            self._commandsSent(commands)
+        self.mapSentTime = time.time()
+        self.framesSent += 1
+        if self.fps:
+            self.sent_counter += 1
+            
+    def _loopDrain(self):
+        """
+        Handles waiting for the connection to catch up, then sends the newest held map.
+        """
+        if self._bufferedBytes() > self.mapBufferLow:
+            self.defereds['drain'] = reactor.callLater(self.drainDelay, self._loopDrain)
+            return
+            
+        self.mapsBackedUp = False
+        #Viewers missed frames, so start again from a whole map
+        self.mapFrames.requestKeyframe()
+        if self.pendingMap is not None:
+            tileMap = self.pendingMap
+            self.pendingMap = None
+            self._sendMap(tileMap, self.pendingMapChanged)
+            self.pendingMapChanged = False
+            
+    def _commandsShown(self, changed):
+        """
+        Returns the tagged commands a frame shows the result of, as [id, client time, ms] lists.
+        They stay pending until _commandsSent, so frames that aren't published don't count.
+        """
+        now = _now()
+        #Commands that never changed the screen
+        self.pendingCommands = [c for c in self.pendingCommands if now - c[2] < self.commandTimeout]
+        if not changed or not self.pendingCommands:
+            return None
+            
+        return [[id, clientTime, int(round((now - injected) * 1000))] for id, clientTime, injected in self.pendingCommands]
+        
+    def _commandsSent(self, shown):
+        """
+        Records the latency of commands shown by a published map, and stops waiting for them.
+        """
+        for id, clientTime, ms in shown:
+            self.inputLatency.add(ms)
+        sent = set((id, clientTime) for id, clientTime, ms in shown)
+        self.pendingCommands = [c for c in self.pendingCommands if (c[0], c[1]) not in sent]
+        
+    def _bufferedBytes(self):
+        """
+        Bytes published but not yet sent.
+        """
+        try:
+            return wamp_local.bufferedBytes(self.connection[0])
+        except:
+            return 0
+            
+    def _sendTilesetDelta(self, version, raw = False):
+        """
+        RPC for tiles added since 'version'. Raw bytes are only sent if this connection can carry them.
+        """
+        return self.tileset.wampSendDelta(version, raw = raw and self.binaryPayloads())
+        
+    def printStages(self):
+        """
+        Logs how long each stage of a frame takes.
+        """
+        prettyConsole.console('log', self.tracer.summary())
+        
+    def toggleProfile(self):
+        """
+        Starts profiling for profileSeconds, or stops early if already running.
+        """
+        if self.profiler.running:
+            prettyConsole.console('log', "Stopping profiler...")
+            self.profiler.stop()
+            return
+        filename = time.strftime("profile-%Y%m%d-%H%M%S.folded")
+        prettyConsole.console('log', "Profiling for %d seconds. Press [p] again to stop." % self.profileSeconds)
+        #Summary is logged from the reactor thread
+        self.profiler.start(self.profileSeconds, filename, done = lambda text: reactor.callFromThread(prettyConsole.console, 'log', text))
+        
+    def binaryPayloads(self):
+        """
+        Whether the connection can send bytes as they are.
+        """
+        try:
+            return self.connection[0].binaryPayloads
+        except:
+            return False
+            
     def _loopPrintFps(self):
         """
         Print number of screen grabs per second.
         """
-        prettyConsole.console('update', "FPS: %0.1f" % (self.fps_counter/5.0))
+        status = "FPS: %0.1f  Sent: %0.1f" % (self.fps_counter/5.0, self.sent_counter/5.0)
+        if self.screenDelayIdle > 0:
+            status += "  (static, every %0.2fs)" % self.screenDelayIdle
+        if self.governor is not None:
+            status += "  CPU: %d%% of %d%%" % (self.governor.usage * 100, self.governor.budget * 100)
+        latency = self.inputLatency.percentiles()
+        if latency is not None:
+            status += "  Input p50/95/99: %d/%d/%d ms" % tuple(latency)
+        if self.drop_counter or self.mapsBackedUp:
+            status += "  Dropped: %d  Buffer: %d KB" % (self.drop_counter, self._bufferedBytes() / 1024)
+        prettyConsole.console('update', status)
         self.fps_counter = 0
+        self.sent_counter = 0
+        self.drop_counter = 0
         
         if self.fps:
             self.defereds['fps'] = reactor.callLater(5, self._loopPrintFps)
@@ -303,11 +713,17 @@ class Game():
         for k, v in self.defereds.iteritems():
             if v.active():
                 v.cancel()
+        if self.damageReader is not None:
+            reactor.removeReader(self.damageReader)
         self.connected = False
         try:
             self.connection[0].disconnect()
         except:
             pass
+        #Make sure newly learned tiles are on disk before exiting
+        if self.tileset is not None:
+            self.tileset.flush()
+        self.tracer.close()
         reactor.callLater(1, reactor.stop)
         
     def reconnect(self):
@@ -324,6 +740,7 @@ class Game():
         
         self.reconnecting = True
         self.retryAttempts += 1
+        self.reconnects += 1
         prettyConsole.console('log', "Reconnecting to server...")
         
         #Cancel pending callbacks
@@ -355,6 +772,11 @@ class Game():
         self.connection = None
         self.subscriptions.clear()
         self.rpcs.clear()
+        #Viewers may have missed frames
+        self.mapFrames.reset()
+        self.mapsBackedUp = False
+        self.pendingMap = None
+        self.pendingMapChanged = False
         
         #Restart connection
         self.connection = wamp_local.wampClient("ws://router1.dfeverywhere.com:7081/ws", "tcp:router1.dfeverywhere.com:7081", self.web_topic, self.web_key)
@@ -0,0 +1,252 @@
+# DF Everywhere
+# Copyright (C) 2015  Travis Painter
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+try:
+    import Image
+except:
+    from PIL import Image
+
+from cStringIO import StringIO
+import numpy
+
+import tileset
+
+class Glyphset(object):
+    """
+    Splits each tile into a glyph, a foreground colour and a background colour.
+    The glyphs and palette stay small no matter how many colours are on screen.
+    Tiles that aren't two colours (graphics sets, anti-aliased fonts) are kept in a regular Tileset.
+    """
+
+    def __init__(self, tset):
+
+        #Fallback for tiles that aren't a glyph
+        self.tileset = tset
+
+        self.tile_x = tset.tile_x
+        self.tile_y = tset.tile_y
+        self.screen_x = 0
+        self.screen_y = 0
+
+        #Glyph masks are True where the foreground colour is drawn.
+        #A glyph is stored so that its top left pixel is background.
+        self.glyphDict = {}
+        self.glyphs = []
+
+        #Colours as [r, g, b]
+        self.paletteDict = {}
+        self.palette = []
+
+        self._payload = None
+        self._payloadVersion = None
+        self._png = None
+        self._pngVersion = None
+
+        #Previous frame, kept to skip tiles that didn't change
+        self._prevFrame = None
+        self._frameDiff = tileset.FrameDiff()
+        #Whether the last parsed frame was different from the one before it
+        self.frameChanged = True
+        self._prevSize = None
+        self._prevPlanes = None
+
+    @property
+    def filename(self):
+        return self.tileset.filename
+
+    @property
+    def learnTime(self):
+        #Only the fallback tileset's learning is timed. New glyphs and colours are cheap.
+        return self.tileset.learnTime
+
+    @property
+    def tilesLearned(self):
+        return self.tileset.tilesLearned
+
+    @property
+    def version(self):
+        #Glyphs, colours and fallback tiles are only ever added, so the sum only grows
+        return len(self.glyphs) + len(self.palette) + self.tileset.version
+
+    def parseImageArray(self, img, dirty = None):
+        """
+        Parses an image as an array. Returns three maps: glyph, foreground colour and background colour.
+        A glyph of -1 means the tile isn't a glyph. Its id in the fallback tileset is in the foreground map.
+        """
+        return self.parseImageIds(img, dirty).tolist()
+
+    def parseImageIds(self, img, dirty = None):
+        """
+        Same as parseImageArray, as a (3, tiles_y, tiles_x) array. 'dirty' is as in Tileset.parseImageIds.
+        """
+        self.tileset.learnTime = 0.0
+        if isinstance(img, numpy.ndarray):
+            img_arr = img
+            image_y, image_x = img.shape[:2]
+            raw = None
+        else:
+            image_x, image_y = img.size
+            raw = img.tobytes()
+            img_arr = numpy.frombuffer(raw, dtype = numpy.uint8).reshape(image_y, image_x, 3)
+        self.screen_x = image_x
+        self.screen_y = image_y
+
+        tiles_x = image_x / self.tile_x
+        tiles_y = image_y / self.tile_y
+
+        tiles = self.tileset._tileBlocks(img_arr, tiles_x, tiles_y)
+        if raw is None:
+            changed = self._frameDiff.changedTiles(img_arr, self.tile_x, self.tile_y, dirty)
+        else:
+            changed = tileset.changedTiles(raw, self._prevFrame if self._prevSize == (image_x, image_y) else None, image_x, image_y, self.tile_x, self.tile_y)
+            self._frameDiff.reset()
+        self.frameChanged = changed is None or len(changed) > 0
+
+        if changed is None:
+            planes = self._planes(tiles.reshape(-1, self.tile_y, self.tile_x, 3))
+        elif len(changed) == 0:
+            #Same frame as last time
+            planes = self._prevPlanes
+        else:
+            planes = self._prevPlanes.copy()
+            planes[:, changed] = self._planes(tiles[changed / tiles_x, changed % tiles_x])
+
+        self._prevFrame = raw
+        self._prevSize = (image_x, image_y)
+        self._prevPlanes = planes
+
+        return planes.reshape(3, tiles_y, tiles_x)
+
+    def _planes(self, tiles):
+        """
+        Returns a (3, count) array of glyph, foreground and background ids for a (count, tile_y, tile_x, 3) array.
+        """
+        count = len(tiles)
+        pixels = tiles.reshape(count, -1, 3).astype(numpy.int32)
+        colours = (pixels[:, :, 0] << 16) | (pixels[:, :, 1] << 8) | pixels[:, :, 2]
+
+        #Top left pixel is the background, the first pixel that differs is the foreground
+        bg = colours[:, 0]
+        masks = colours != bg[:, numpy.newaxis]
+        fg = colours[numpy.arange(count), masks.argmax(axis = 1)]
+        twoColour = (~masks | (colours == fg[:, numpy.newaxis])).all(axis = 1)
+
+        planes = numpy.empty((3, count), dtype = numpy.int64)
+        glyph = numpy.flatnonzero(twoColour)
+        if len(glyph):
+            planes[0, glyph] = self._glyphIds(masks[glyph])
+            planes[1, glyph] = self._colourIds(fg[glyph])
+            planes[2, glyph] = self._colourIds(bg[glyph])
+
+        other = numpy.flatnonzero(~twoColour)
+        if len(other):
+            planes[0, other] = -1
+            planes[1, other] = self.tileset.tileIds(tiles[other])
+            planes[2, other] = -1
+        return planes
+
+    def _glyphIds(self, masks):
+        """
+        Returns the id of each glyph mask. Unseen glyphs are added.
+        """
+        packed = numpy.ascontiguousarray(numpy.packbits(masks, axis = 1))
+        rows = packed.view(numpy.dtype((numpy.void, packed.shape[1]))).ravel()
+        unique, first, inverse = numpy.unique(rows, return_index = True, return_inverse = True)
+
+        ids = numpy.empty(len(unique), dtype = numpy.int64)
+        for i in xrange(len(unique)):
+            key = packed[first[i]].tostring()
+            glyph = self.glyphDict.get(key)
+            if glyph is None:
+                glyph = len(self.glyphs)
+                self.glyphDict[key] = glyph
+                self.glyphs.append(masks[first[i]].reshape(self.tile_y, self.tile_x))
+            ids[i] = glyph
+        return ids[inverse]
+
+    def _colourIds(self, colours):
+        """
+        Returns the palette index of each packed colour. Unseen colours are added.
+        """
+        unique, inverse = numpy.unique(colours, return_inverse = True)
+
+        ids = numpy.empty(len(unique), dtype = numpy.int64)
+        for i, colour in enumerate(unique.tolist()):
+            index = self.paletteDict.get(colour)
+            if index is None:
+                index = len(self.palette)
+                self.paletteDict[colour] = index
+                self.palette.append([colour >> 16, (colour >> 8) & 0xFF, colour & 0xFF])
+            ids[i] = index
+        return ids[inverse]
+
+    def getImage(self):
+        """
+        Returns the glyphs as a white on black image, laid out like a tileset.
+        """
+        width = tileset._atlasWidth
+        rows = max(1, (len(self.glyphs) + width - 1) / width)
+        atlas = numpy.zeros((rows * width, self.tile_y, self.tile_x), dtype = numpy.uint8)
+        if self.glyphs:
+            atlas[:len(self.glyphs)] = numpy.array(self.glyphs) * 255
+        atlas = atlas.reshape(rows, width, self.tile_y, self.tile_x).swapaxes(1, 2)
+        return Image.fromarray(atlas.reshape(rows * self.tile_y, width * self.tile_x))
+
+    def wampSend(self):
+        """
+        Returns the glyph image, palette and fallback tileset so that they can be sent via WAMP.
+        Only re-encoded when the version changes.
+        """
+        if self._payloadVersion != self.version:
+            self._payload = {'glyphs': self._glyphPng().encode("base64"),
+                            'palette': list(self.palette),
+                            'tiles': self.tileset.wampSend(),
+                            'version': self.version}
+            self._payloadVersion = self.version
+        return self._payload
+
+    def wampSendRaw(self):
+        """
+        Same as wampSend, with the images as bytes for sessions that can send binary data.
+        """
+        return {'glyphs': self._glyphPng(),
+                'palette': list(self.palette),
+                'tiles': self.tileset.wampSendRaw(),
+                'version': self.version}
+
+    def _glyphPng(self):
+        """
+        Returns the glyph image as png bytes. Only re-encoded when the version changes.
+        """
+        if self._pngVersion != self.version:
+            img_io = StringIO()
+            self.getImage().save(img_io, 'png', optimize = True)
+            self._png = img_io.getvalue()
+            self._pngVersion = self.version
+        return self._png
+
+    def wampSendDelta(self, version, raw = False):
+        """
+        Glyphs and palette are small, so this always sends everything.
+        """
+        return {'version': self.version, 'full': self.wampSendRaw() if raw else self.wampSend()}
+
+    def flush(self):
+        """
+        Waits until the fallback tileset has been written to disk.
+        """
+        self.tileset.flush()
@@ -0,0 +1,101 @@
+# DF Everywhere
+# Copyright (C) 2015  Travis Painter
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import time
+
+import prettyConsole
+
+def cpuTime():
+    """
+    Returns the CPU time used by this process so far, all threads included.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+class CpuGovernor:
+    """
+    Spaces out screen grabs so that this process uses at most 'budget' of one core.
+    Dwarf Fortress runs on a single core, so CPU used here can slow the game down.
+    """
+
+    def __init__(self, budget = 0.25, maxDelay = 1.0):
+        self.budget = budget
+        self.maxDelay = maxDelay
+        #Extra delay between screen grabs
+        self.delay = 0.0
+        #Share of one core used over the last update
+        self.usage = 0.0
+
+        self._frames = 0
+        self._lastCpu = cpuTime()
+        self._lastWall = time.time()
+
+    def frame(self):
+        """
+        Counts a screen grab.
+        """
+        self._frames += 1
+
+    def update(self):
+        """
+        Measures CPU use since the last update and adjusts the delay. Call about once a second.
+        """
+        cpu = cpuTime()
+        wall = time.time()
+        usedCpu = cpu - self._lastCpu
+        usedWall = wall - self._lastWall
+        frames = self._frames
+        self._lastCpu = cpu
+        self._lastWall = wall
+        self._frames = 0
+
+        if usedWall <= 0:
+            return
+        self.usage = usedCpu / usedWall
+        if frames == 0:
+            return
+
+        #Per frame: CPU time, and time spent neither working nor in the delay (waiting for screenshots, the network)
+        cost = usedCpu / frames
+        waiting = max(0.0, usedWall / frames - cost - self.delay)
+        #cost / (cost + waiting + delay) <= budget
+        target = min(max(0.0, cost / self.budget - cost - waiting), self.maxDelay)
+        #Move half way, so one odd second doesn't swing the rate
+        self.delay = (self.delay + target) / 2
+
+def lowerPriority(nice = None, cpus = None):
+    """
+    Optionally lowers this process's priority and keeps it off the CPUs Dwarf Fortress uses.
+    'cpus' is a list of CPU numbers this process may run on.
+    """
+    if nice:
+        try:
+            os.nice(nice)
+            prettyConsole.console('log', "Niceness raised by %d." % nice)
+        except (AttributeError, OSError):
+            prettyConsole.console('log', "Unable to change niceness on this system.")
+
+    if cpus:
+        try:
+            import psutil
+            psutil.Process(os.getpid()).cpu_affinity(cpus)
+            prettyConsole.console('log', "Running on CPUs: %s" % ", ".join(str(c) for c in cpus))
+        except ImportError:
+            prettyConsole.console('log', "Install psutil to set CPU affinity.")
+        except Exception as inst:
+            prettyConsole.console('log', "Unable to set CPU affinity: %s" % inst)
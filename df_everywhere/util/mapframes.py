@@ -0,0 +1,192 @@
+# DF Everywhere
+# Copyright (C) 2015  Travis Painter
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import struct
+import numpy
+
+#Binary map header: magic, format, flags, planes, tiles_x, tiles_y, tileset version, sequence number, base sequence number.
+#Everything is little-endian. The body follows straight after.
+_header = struct.Struct('<4sBBHHHIII')
+_magic = 'DFMP'
+_format = 1
+
+#Header flags
+RUNS = 1    #body is run-length encoded: run count (uint32), run lengths (uint16), then run ids
+DELTA = 2   #body is changes since 'base': change count (uint32), positions (uint32), then ids
+WIDE = 4    #ids are uint32 instead of uint16
+
+#Longest run that fits in a uint16 length
+_maxRun = 0xFFFF
+
+def packMap(ids, version, seq, runs = True):
+    """
+    Packs a whole map of tile ids. Ids of -1 are sent as the largest id value.
+    With 'runs', repeated ids are run-length encoded if that is smaller.
+    """
+    planes, tiles_y, tiles_x = _dimensions(ids.shape)
+    flat = ids.ravel()
+    flags, idType = _idType(flat)
+    body = flat.astype(idType).tostring()
+
+    if runs and len(flat):
+        starts = numpy.flatnonzero(numpy.concatenate(([True], flat[1:] != flat[:-1])))
+        lengths = numpy.diff(numpy.append(starts, len(flat)))
+        values = flat[starts]
+        if len(starts) * (2 + idType.itemsize) + 4 < len(body):
+            #Split runs too long for a uint16 length
+            chunks = (lengths + _maxRun - 1) / _maxRun
+            if (chunks > 1).any():
+                values = numpy.repeat(values, chunks)
+                last = numpy.cumsum(chunks) - 1
+                split = numpy.empty(len(values), dtype = lengths.dtype)
+                split.fill(_maxRun)
+                split[last] = lengths - (chunks - 1) * _maxRun
+                lengths = split
+            flags |= RUNS
+            body = struct.pack('<I', len(values)) + lengths.astype('<u2').tostring() + values.astype(idType).tostring()
+
+    return _header.pack(_magic, _format, flags, planes, tiles_x, tiles_y, version, seq, 0) + body
+
+def packChanges(shape, positions, values, version, seq, base):
+    """
+    Packs the tiles that changed since frame 'base'. Positions index the map flattened in row order.
+    """
+    planes, tiles_y, tiles_x = _dimensions(shape)
+    flags, idType = _idType(values)
+    body = struct.pack('<I', len(positions)) + positions.astype('<u4').tostring() + values.astype(idType).tostring()
+    return _header.pack(_magic, _format, flags | DELTA, planes, tiles_x, tiles_y, version, seq, base) + body
+
+def unpack(data):
+    """
+    Reference decoder. Returns a dict with 'version', 'seq' and 'shape', and either 'map', an array of ids,
+    or 'base' and 'changes', arrays of positions and ids.
+    """
+    magic, format, flags, planes, tiles_x, tiles_y, version, seq, base = _header.unpack_from(data)
+    if magic != _magic or format != _format:
+        raise ValueError("Not a binary map")
+
+    idType = numpy.dtype('<u4' if flags & WIDE else '<u2')
+    shape = (tiles_y, tiles_x) if planes == 1 else (planes, tiles_y, tiles_x)
+    frame = {'version': version, 'seq': seq, 'shape': shape}
+    offset = _header.size
+
+    if flags & DELTA:
+        count = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        positions = numpy.frombuffer(data, dtype = '<u4', count = count, offset = offset)
+        values = numpy.frombuffer(data, dtype = idType, count = count, offset = offset + 4 * count)
+        frame['base'] = base
+        frame['changes'] = (positions.astype(numpy.int64), _signedIds(values))
+    elif flags & RUNS:
+        count = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        lengths = numpy.frombuffer(data, dtype = '<u2', count = count, offset = offset)
+        values = numpy.frombuffer(data, dtype = idType, count = count, offset = offset + 2 * count)
+        frame['map'] = numpy.repeat(_signedIds(values), lengths).reshape(shape)
+    else:
+        values = numpy.frombuffer(data, dtype = idType, count = planes * tiles_x * tiles_y, offset = offset)
+        frame['map'] = _signedIds(values).reshape(shape)
+    return frame
+
+def _dimensions(shape):
+    """
+    Returns planes, tiles_y, tiles_x for a tile map or a glyph map.
+    """
+    if len(shape) == 2:
+        return (1,) + tuple(shape)
+    return tuple(shape)
+
+def _idType(ids):
+    """
+    Returns the header flags and array type needed for the ids.
+    """
+    if len(ids) and ids.max() >= 0xFFFF:
+        return WIDE, numpy.dtype('<u4')
+    return 0, numpy.dtype('<u2')
+
+def _signedIds(values):
+    """
+    Turns the largest id value back into -1.
+    """
+    ids = values.astype(numpy.int64)
+    ids[values == numpy.iinfo(values.dtype).max] = -1
+    return ids
+
+class MapFrames:
+    """
+    Turns tile maps into keyframes and deltas for the map event.
+
+    Every frame has a sequence number 'seq'. A keyframe holds the whole map in 'map'.
+    A delta holds 'base', the sequence number it applies to, and 'changes', a flat list of
+    position, tile id pairs. Positions index the map flattened in row order.
+    A viewer that sees a gap in the sequence numbers should ask for a keyframe.
+    With 'binary' set, frames are packed with packMap and packChanges instead.
+    """
+
+    def __init__(self, keyframeInterval = 100, binary = False, runs = True):
+        #Send a whole map at least this often, so late joiners don't wait long
+        self.keyframeInterval = keyframeInterval
+        self.binary = binary
+        self.runs = runs
+        self.sequence = 0
+        self.keyframeRequested = True
+
+        self._sent = None
+        self._sinceKeyframe = 0
+
+    def requestKeyframe(self):
+        """
+        Makes the next frame a keyframe. Returns the sequence number of the last frame sent.
+        """
+        self.keyframeRequested = True
+        return self.sequence
+
+    def encode(self, ids, version = 0):
+        """
+        Returns the map event for an array of tile ids. 'version' is the tileset version the ids refer to.
+        """
+        self.sequence += 1
+
+        if self.keyframeRequested or self._sent is None or self._sent.shape != ids.shape or self._sinceKeyframe >= self.keyframeInterval - 1:
+            if self.binary:
+                frame = packMap(ids, version, self.sequence, runs = self.runs)
+            else:
+                frame = {'seq': self.sequence, 'map': ids.tolist()}
+            self.keyframeRequested = False
+            self._sinceKeyframe = 0
+        else:
+            flat = ids.ravel()
+            changed = numpy.flatnonzero(flat != self._sent.ravel())
+            if self.binary:
+                frame = packChanges(ids.shape, changed, flat[changed], version, self.sequence, self.sequence - 1)
+            else:
+                pairs = numpy.empty((len(changed), 2), dtype = numpy.int64)
+                pairs[:, 0] = changed
+                pairs[:, 1] = flat[changed]
+                frame = {'seq': self.sequence, 'base': self.sequence - 1, 'changes': pairs.ravel().tolist()}
+            self._sinceKeyframe += 1
+
+        #Parsers may hand back the same array next frame, so keep a copy
+        self._sent = ids.copy()
+        return frame
+
+    def reset(self):
+        """
+        Starts over with a keyframe, e.g. after reconnecting.
+        """
+        self._sent = None
+        self.keyframeRequested = True
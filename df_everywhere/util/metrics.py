@@ -0,0 +1,109 @@
+# DF Everywhere
+# Copyright (C) 2015  Travis Painter
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Prometheus text format metrics, served by the reactor on a local port.
+# Everything is read from the Game when scraped, so nothing is added to the frame loop.
+#
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+import prettyConsole
+
+class MetricsResource(resource.Resource):
+    """
+    Serves the Game's counters and gauges in Prometheus text format.
+    """
+    isLeaf = True
+
+    def __init__(self, game):
+        resource.Resource.__init__(self)
+        self.game = game
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return "".join(self._lines())
+
+    def _lines(self):
+        """
+        Yields each line of the metrics page.
+        """
+        game = self.game
+        tset = game.tileset
+
+        for name, kind, text, value in [
+                ('frames_captured_total', 'counter', "Screen grabs.", game.screenCycles),
+                ('frames_published_total', 'counter', "Maps sent to viewers.", game.framesSent),
+                ('frames_skipped_total', 'counter', "Maps not sent because the screen didn't change.", game.framesSkipped),
+                ('frames_dropped_total', 'counter', "Maps replaced by a newer one while the connection was behind.", game.framesDropped),
+                ('commands_total', 'counter', "Commands received from viewers.", game.commandsReceived),
+                ('heartbeats_total', 'counter', "Heartbeats received from viewers.", game.heartbeatsReceived),
+                ('reconnects_total', 'counter', "Reconnects to the WAMP router.", game.reconnects),
+                ('connected', 'gauge', "1 when connected to the WAMP router.", int(game.connected)),
+                ('viewers_active', 'gauge', "1 while viewers are sending heartbeats.", int(not game.slowed)),
+                ('send_buffer_bytes', 'gauge', "Bytes published but not yet sent.", game._bufferedBytes())]:
+            for line in _metric(name, kind, text, value):
+                yield line
+
+        if tset is not None:
+            for line in _metric('tileset_version', 'gauge', "Tileset version. Only grows.", tset.version):
+                yield line
+            if hasattr(tset, 'tileCount'):
+                for line in _metric('tileset_tiles', 'gauge', "Tiles in the tileset.", tset.tileCount):
+                    yield line
+            for line in _metric('tiles_learned_total', 'counter', "Tiles added to the tileset this session.", getattr(tset, 'tilesLearned', 0)):
+                yield line
+
+        yield _help('published_messages_total', 'counter', "Messages published, by topic.")
+        for topic, count in sorted(game.publishCounts.iteritems()):
+            yield 'dfeverywhere_published_messages_total{topic="%s"} %d\n' % (topic, count)
+        yield _help('published_bytes_total', 'counter', "Bytes of published messages as serialized, by topic.")
+        for topic, count in sorted(game.publishBytes.iteritems()):
+            yield 'dfeverywhere_published_bytes_total{topic="%s"} %d\n' % (topic, count)
+
+        yield _help('stage_milliseconds', 'summary', "Time spent in each stage of a frame, over recent frames.")
+        for stage in game.tracer.stages:
+            histogram = game.tracer.histograms[stage]
+            p = histogram.percentiles((50, 95, 99))
+            if p is None:
+                continue
+            for q, value in zip(['0.5', '0.95', '0.99'], p):
+                yield 'dfeverywhere_stage_milliseconds{stage="%s",quantile="%s"} %f\n' % (stage, q, value)
+            yield 'dfeverywhere_stage_milliseconds_count{stage="%s"} %d\n' % (stage, histogram.count)
+
+        p = game.inputLatency.percentiles((50, 95, 99))
+        if p is not None:
+            yield _help('input_latency_milliseconds', 'summary', "Time from injecting a command to sending the first changed map.")
+            for q, value in zip(['0.5', '0.95', '0.99'], p):
+                yield 'dfeverywhere_input_latency_milliseconds{quantile="%s"} %f\n' % (q, value)
+            yield 'dfeverywhere_input_latency_milliseconds_count %d\n' % game.inputLatency.count
+
+def _help(name, kind, text):
+    return "# HELP dfeverywhere_%s %s\n# TYPE dfeverywhere_%s %s\n" % (name, text, name, kind)
+
+def _metric(name, kind, text, value):
+    return [_help(name, kind, text), "dfeverywhere_%s %s\n" % (name, value)]
+
+def listen(game, port, interface = '127.0.0.1'):
+    """
+    Serves metrics at http://interface:port/metrics from the reactor. Local only by default.
+    """
+    root = resource.Resource()
+    root.putChild('metrics', MetricsResource(game))
+    reactor.listenTCP(port, server.Site(root), interface = interface)
+    prettyConsole.console('log', "Metrics at http://%s:%d/metrics" % (interface, port))
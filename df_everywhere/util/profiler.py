@@ -0,0 +1,130 @@
+# DF Everywhere
+# Copyright (C) 2015  Travis Painter
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import sys
+import threading
+import time
+
+#Subsystem of a stack is the first of these found walking out from the innermost frame.
+#Each pattern is the end of a file path starting at a directory boundary, or a directory if it ends in '/'.
+#Only this program's modules, autobahn, and the reactor and thread waits are listed, so other libraries like
+#numpy, PIL, Xlib and pywin32 count towards their caller.
+#Patterns are tried in order, so the more specific ones come first.
+_subsystems = [
+    ('idle', ['twisted/internet/win32eventreactor.py', 'twisted/internet/epollreactor.py', 'twisted/internet/selectreactor.py',
+              'twisted/internet/pollreactor.py', 'twisted/internet/gtk2reactor.py', 'threading.py', 'Queue.py', 'util/consoleInput.py']),
+    ('capture', ['util/utils.py', 'util/xcapture.py']),
+    ('tileset', ['util/tileset.py', 'util/glyphset.py', 'util/mapframes.py']),
+    ('wamp', ['util/wamp_local.py', 'autobahn/']),
+    ('game loop', ['util/game.py', 'util/sendInput.py', 'util/SendKeys.py', 'util/_sendkeys.py']),
+]
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread at a fixed interval from a background thread.
+    Stacks are counted and written in collapsed stack format (one 'frame;frame;... count' per line),
+    which flamegraph.pl and speedscope read. The first frame of each stack is its subsystem.
+    """
+
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.running = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, seconds, filename, done = None):
+        """
+        Profiles for 'seconds', then writes 'filename'. 'done' is called from the profiler thread with a summary line.
+        """
+        if self.running:
+            return
+        self.running = True
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, args = (seconds, filename, done), name = "SamplingProfiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Ends profiling early. The file is still written.
+        """
+        self._stop.set()
+
+    def _run(self, seconds, filename, done):
+        """
+        Profiler thread.
+        """
+        try:
+            self._profile(seconds, filename, done)
+        except (IOError, OSError), e:
+            if done is not None:
+                done("Unable to write profile to %s: %s" % (filename, e))
+        finally:
+            #Whatever happened, the next profile can start
+            self.running = False
+
+    def _profile(self, seconds, filename, done):
+        """
+        Samples every other thread's stack, writes the collapsed stacks and reports the split by subsystem.
+        """
+        counts = {}
+        samples = 0
+        me = threading.current_thread().ident
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        end = time.time() + seconds
+
+        while time.time() < end and not self._stop.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                key = (ident, tuple(stack))
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            self._stop.wait(self.interval)
+        #Threads started while profiling
+        names.update((t.ident, t.name) for t in threading.enumerate())
+
+        bySubsystem = {}
+        with open(filename, 'w') as f:
+            for (ident, stack), count in counts.iteritems():
+                subsystem = _subsystem(stack)
+                bySubsystem[subsystem] = bySubsystem.get(subsystem, 0) + count
+                frames = [subsystem, names.get(ident, str(ident))]
+                frames.extend("%s (%s)" % (code.co_name, os.path.basename(code.co_filename)) for code in reversed(stack))
+                f.write("%s %d\n" % (";".join(frame.replace(';', ':') for frame in frames), count))
+
+        if done is not None:
+            total = float(max(1, sum(bySubsystem.values())))
+            parts = ["%s %d%%" % (name, bySubsystem[name] * 100 / total) for name in sorted(bySubsystem, key = bySubsystem.get, reverse = True)]
+            done("Profile written to %s (%d samples): %s" % (filename, samples, ", ".join(parts)))
+
+def _subsystem(stack):
+    """
+    Names the subsystem of a stack, innermost frame first.
+    """
+    for code in stack:
+        path = '/' + code.co_filename.replace('\\', '/')
+        for name, patterns in _subsystems:
+            for pattern in patterns:
+                if (('/' + pattern) in path) if pattern.endswith('/') else path.endswith('/' + pattern):
+                    return name
+    return 'other'
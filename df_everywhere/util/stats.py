@@ -0,0 +1,161 @@
+# DF Everywhere
+# Copyright (C) 2015  Travis Painter
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import sys
+import time
+import numpy
+
+def _monotonicClock():
+    """
+    Returns a clock that never goes backwards, in seconds.
+    """
+    try:
+        return time.monotonic
+    except AttributeError:
+        pass
+    if sys.platform == 'win32':
+        #Performance counter on Windows
+        return time.clock
+    try:
+        import ctypes
+        import ctypes.util
+        import os
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 1
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno = True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        spec = timespec()
+        def monotonic():
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = _monotonicClock()
+
+class RollingHistogram:
+    """
+    Keeps the last 'size' samples and reports percentiles of them.
+    Adding a sample doesn't allocate, so it can be used once per frame.
+    """
+
+    def __init__(self, size = 1000):
+        self._samples = numpy.zeros(size)
+        #Total number of samples added
+        self.count = 0
+
+    def add(self, value):
+        """
+        Adds a sample, replacing the oldest one once full.
+        """
+        self._samples[self.count % len(self._samples)] = value
+        self.count += 1
+
+    def percentiles(self, q = (50, 95, 99)):
+        """
+        Returns the percentiles 'q' of the kept samples, or None if there aren't any.
+        """
+        kept = min(self.count, len(self._samples))
+        if kept == 0:
+            return None
+        return numpy.percentile(self._samples[:kept], q)
+
+class FrameTracer:
+    """
+    Times the stages of each frame. Each frame gets a sequence number and the time between
+    stage boundaries goes into a rolling histogram per stage.
+    Optionally writes every stage to a file as Chrome trace events (chrome://tracing, ui.perfetto.dev).
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.histograms = dict((stage, RollingHistogram()) for stage in stages)
+        self.sequence = 0
+
+        self._origin = monotonic()
+        self._last = self._origin
+        self._traceFile = None
+
+    def open(self, filename):
+        """
+        Starts writing trace events to 'filename'.
+        """
+        self._traceFile = open(filename, 'w')
+        #The closing bracket is optional in the trace event format, so the file is usable even if it isn't closed
+        self._traceFile.write("[\n")
+
+    def close(self):
+        if self._traceFile is not None:
+            self._traceFile.write("{}]\n")
+            self._traceFile.close()
+            self._traceFile = None
+
+    def start(self):
+        """
+        Starts a new frame. Returns its sequence number.
+        """
+        self.sequence += 1
+        self._last = monotonic()
+        return self.sequence
+
+    def mark(self, stage, inner = None):
+        """
+        Ends 'stage' of the current frame, which started at the last mark.
+        'inner' is an optional (stage, seconds) that was part of this stage, such as learning new tiles during parsing.
+        It is taken out of this stage's time and shown at the end of it.
+        """
+        now = monotonic()
+        start = self._last
+        self._last = now
+
+        innerTime = 0.0
+        if inner is not None and inner[1] > 0:
+            innerTime = inner[1]
+            self.histograms[inner[0]].add(innerTime * 1000)
+        self.histograms[stage].add((now - start - innerTime) * 1000)
+
+        if self._traceFile is not None:
+            self._event(stage, start, now)
+            if innerTime:
+                self._event(inner[0], now - innerTime, now)
+
+    def _event(self, stage, start, end):
+        """
+        Writes one complete trace event. Times are in microseconds since the tracer was made.
+        """
+        self._traceFile.write(json.dumps({'name': stage, 'ph': 'X', 'pid': 1, 'tid': 1,
+                                          'ts': int((start - self._origin) * 1e6), 'dur': int((end - start) * 1e6),
+                                          'args': {'seq': self.sequence}}) + ",\n")
+
+    def summary(self):
+        """
+        Returns a line of median and 95th percentile milliseconds for each stage.
+        """
+        parts = []
+        for stage in self.stages:
+            p = self.histograms[stage].percentiles((50, 95))
+            if p is not None:
+                parts.append("%s %0.1f/%0.1f" % (stage, p[0], p[1]))
+        return "Frame %d, ms p50/p95: %s" % (self.sequence, "  ".join(parts))
@@ -22,19 +22,322 @@ except:
     from PIL import Image
     from PIL import ImageChops
 
+import hashlib
+import os
+import struct
 import sys
+import threading
+import zlib
 from cStringIO import StringIO
 #import mmh3
 import numpy
 
 import prettyConsole
+import stats
+
+#Number of tiles to place across the width of the tileset image
+_atlasWidth = 32
+
+#Largest number of new tiles sent by wampSendDelta before sending the whole tileset instead
+_maxDeltaTiles = 512
+
+#Seed for the tile fingerprint weights. Fixed so fingerprints match between runs.
+_fingerprintSeed = 0xDF
+
+def _fingerprintWeights(words):
+    """
+    Returns odd 64-bit weights used to reduce a tile of 32-bit words to a single key.
+    """
+    rand = numpy.random.RandomState(_fingerprintSeed)
+    weights = numpy.frombuffer(rand.bytes(8 * words), dtype = '<u8').copy()
+    #Odd weights can't cancel out a single changed word
+    weights |= numpy.uint64(1)
+    return weights
+
+#Sidecar index: header, then the sorted tile keys, their ids, and the tileset pixels uncompressed.
+#Header is: magic, index format, fingerprint seed, tile_x, tile_y, tile count, md5 of the tileset png.
+#With the pixels in the index, loading doesn't have to decode the png.
+_indexHeader = struct.Struct('<4sHHHHI16s')
+_indexMagic = 'DFTI'
+_indexFormat = 3
+#zlib level for the pixels in the index. Tilesets are mostly flat colour, so the fastest level already shrinks them a lot.
+_indexLevel = 1
+
+#Near match signature: mean colour of each cell in a grid this many cells across and down
+_signatureGrid = 4
+
+def _indexFilename(filename):
+    """
+    Returns the index filename for a tileset image filename.
+    """
+    return os.path.splitext(filename)[0] + '.idx'
+    
+def _replaceFile(temp, path):
+    """
+    Renames temp over path.
+    """
+    if os.name == 'nt' and os.path.exists(path):
+        #Windows won't rename over an existing file
+        os.remove(path)
+    os.rename(temp, path)
+
+def _writeIndex(path, checksum, tile_x, tile_y, keys, ids, pixels):
+    """
+    Writes the sorted tile keys and ids, and the compressed tileset pixels, next to a tileset image.
+    """
+    temp = path + ".tmp"
+    with open(temp, 'wb') as f:
+        f.write(_indexHeader.pack(_indexMagic, _indexFormat, _fingerprintSeed, tile_x, tile_y, len(keys), checksum))
+        f.write(numpy.asarray(keys, dtype = '<u8').tostring())
+        f.write(numpy.asarray(ids, dtype = '<i8').tostring())
+        f.write(zlib.compress(numpy.ascontiguousarray(pixels).data, _indexLevel))
+    _replaceFile(temp, path)
+    
+def _readIndex(path, checksum, tile_x, tile_y, count):
+    """
+    Maps the keys and ids of a tile index into memory and decompresses its pixels. Returns (keys, ids, pixels),
+    or None if the index is missing, cut short, or doesn't match the tileset image.
+    """
+    rows = (count + _atlasWidth - 1) / _atlasWidth
+    pixelsShape = (rows * tile_y, _atlasWidth * tile_x, 3)
+    try:
+        with open(path, 'rb') as f:
+            header = _indexHeader.unpack(f.read(_indexHeader.size))
+        size = os.path.getsize(path)
+    except (IOError, OSError, struct.error):
+        return None
+        
+    if header != (_indexMagic, _indexFormat, _fingerprintSeed, tile_x, tile_y, count, checksum):
+        return None
+    if count == 0 or size <= _indexHeader.size + 16 * count:
+        return None
+        
+    keys = numpy.memmap(path, dtype = '<u8', mode = 'r', offset = _indexHeader.size, shape = (count,))
+    ids = numpy.memmap(path, dtype = '<i8', mode = 'r', offset = _indexHeader.size + 8 * count, shape = (count,))
+    #Keys are sorted and unique, and each tile has exactly one id
+    if (keys[1:] <= keys[:-1]).any() or ids.min() < 0 or ids.max() >= count or (numpy.bincount(ids, minlength = count) != 1).any():
+        return None
+    try:
+        with open(path, 'rb') as f:
+            f.seek(_indexHeader.size + 16 * count)
+            pixels = zlib.decompress(f.read())
+    except (IOError, zlib.error):
+        return None
+    if len(pixels) != numpy.prod(pixelsShape):
+        return None
+    return keys, ids, numpy.frombuffer(pixels, dtype = numpy.uint8).reshape(pixelsShape)
+
+def changedTiles(raw, prev, image_x, image_y, tile_x, tile_y):
+    """
+    Compares the raw RGB bytes of a frame to the previous frame of the same size. Returns the flat positions
+    of tiles whose pixels changed, or None if there is no previous frame to compare against.
+    Checks the whole frame, then each row of tiles, then only the tiles in rows that changed.
+    """
+    if prev is None:
+        return None
+        
+    if raw == prev:
+        return numpy.zeros(0, dtype = numpy.intp)
+        
+    tiles_x = image_x / tile_x
+    tiles_y = image_y / tile_y
+    bandBytes = image_x * 3 * tile_y
+    bands = [b for b in xrange(tiles_y) if buffer(raw, b * bandBytes, bandBytes) != buffer(prev, b * bandBytes, bandBytes)]
+    if not bands:
+        #Only the partial tiles along the edges changed
+        return numpy.zeros(0, dtype = numpy.intp)
+        
+    #Compare each tile in the changed rows
+    bands = numpy.array(bands, dtype = numpy.intp)
+    shape = (tiles_y, tile_y, tiles_x, tile_x * 3)
+    cur = numpy.frombuffer(raw, dtype = numpy.uint8).reshape(image_y, image_x * 3)[:tiles_y * tile_y, :tiles_x * tile_x * 3]
+    old = numpy.frombuffer(prev, dtype = numpy.uint8).reshape(image_y, image_x * 3)[:tiles_y * tile_y, :tiles_x * tile_x * 3]
+    diff = cur.reshape(shape)[bands] != old.reshape(shape)[bands]
+    rows, cols = numpy.nonzero(diff.any(axis = 3).any(axis = 1))
+    return bands[rows] * tiles_x + cols
+
+class _ArrayInterface(object):
+    """
+    Lets numpy.asarray make an array from a hand made __array_interface__, keeping 'base' alive.
+    """
+    def __init__(self, interface, base):
+        self.__array_interface__ = interface
+        self.base = base
+
+def _pixelWords(img_arr):
+    """
+    Returns a (height, width) uint32 view of the pixels of a (height, width, 3) view into a 4 byte per pixel
+    buffer (BGRX or RGBX), padding byte included. Comparing whole words is much faster than comparing
+    channels of a strided view. Returns the array unchanged if it isn't laid out like that.
+    """
+    if img_arr.ndim != 3 or img_arr.shape[2] != 3 or img_arr.strides[1] != 4 or abs(img_arr.strides[2]) != 1:
+        return img_arr
+    interface = dict(img_arr.__array_interface__)
+    address = interface['data'][0] + min(0, 2 * img_arr.strides[2])
+    interface.update(shape = img_arr.shape[:2], strides = img_arr.strides[:2], typestr = numpy.dtype(numpy.uint32).str,
+                     data = (address, True))
+    interface.pop('descr', None)
+    return numpy.asarray(_ArrayInterface(interface, img_arr))
+
+class FrameDiff:
+    """
+    changedTiles for frames that are arrays, such as a view into a capture buffer.
+    Keeps its own copy of the last frame. Only rows of tiles that changed are copied into it, and the
+    comparison reuses one row of scratch space, so no frame sized arrays are allocated after the first frame.
+    """
+
+    def __init__(self):
+        self._prev = None
+        self._scratch = None
+        self.valid = False
+
+    def reset(self):
+        """
+        Forgets the last frame. The next one is treated as all new.
+        """
+        self.valid = False
+
+    def changedTiles(self, img_arr, tile_x, tile_y, dirty = None):
+        """
+        Returns the flat positions of whole tiles that changed since the last frame,
+        or None if there is no previous frame of the same size.
+        'dirty' optionally lists the (x, y, width, height) rectangles that could have changed. Only rows of tiles under them are compared.
+        """
+        tiles_x = img_arr.shape[1] / tile_x
+        tiles_y = img_arr.shape[0] / tile_y
+        cur = _pixelWords(img_arr[:tiles_y * tile_y, :tiles_x * tile_x])
+
+        if not self.valid or self._prev.shape != cur.shape or self._prev.dtype != cur.dtype:
+            if self._prev is None or self._prev.shape != cur.shape or self._prev.dtype != cur.dtype:
+                self._prev = numpy.empty(cur.shape, dtype = cur.dtype)
+                self._scratch = numpy.empty((tile_y,) + cur.shape[1:], dtype = numpy.bool_)
+            self._prev[...] = cur
+            self.valid = True
+            return None
+
+        scratch = self._scratch
+        #One row of tiles: (tile_y, tiles_x, tile_x * values per pixel)
+        tileRow = scratch.reshape(tile_y, tiles_x, -1)
+        if dirty is None:
+            bands = xrange(tiles_y)
+        else:
+            bands = set()
+            for x, y, w, h in dirty:
+                bands.update(xrange(max(0, y) / tile_y, min(tiles_y, (y + h + tile_y - 1) / tile_y)))
+            bands = sorted(bands)
+        changed = []
+        for b in bands:
+            rows = slice(b * tile_y, (b + 1) * tile_y)
+            numpy.not_equal(cur[rows], self._prev[rows], out = scratch)
+            if scratch.any():
+                changed.append(numpy.flatnonzero(tileRow.any(axis = 2).any(axis = 0)) + b * tiles_x)
+                self._prev[rows] = cur[rows]
+        if not changed:
+            return numpy.zeros(0, dtype = numpy.intp)
+        return numpy.concatenate(changed)
+
+class TilesetSaver:
+    """
+    Writes tileset images to disk on a background thread.
+    Saves requested while a write is running are coalesced into one write of the newest tileset.
+    Each image holds every tile of the ones before it, so the previous image and its index are removed once a new one is written.
+    """
+    
+    def __init__(self, tile_x, tile_y, directory = "./tilesets"):
+        self.tile_x = tile_x
+        self.tile_y = tile_y
+        self.directory = directory
+        #Tileset image on disk, replaced by the next one written
+        self.current = None
+        self._pending = None
+        self._busy = False
+        self._lock = threading.Condition()
+        self._thread = None
+        
+    def save(self, filename, atlas, rows, keys = None, ids = None, checksum = None):
+        """
+        Queues a save of the first 'rows' pixel rows of the tileset array. Returns immediately.
+        Tiles already in the array must not be changed afterwards. Free slots in the last row may still be filled
+        while it is written. They are past the tile count in the file name, so loading ignores them.
+        If the sorted tile keys and ids are given, an index with them and the pixels is written next to the image.
+        With the md5 'checksum' of the image already on disk, only the index is written.
+        """
+        with self._lock:
+            self._pending = (filename, atlas, rows, keys, ids, checksum)
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, name = "TilesetSaver")
+                self._thread.daemon = True
+                self._thread.start()
+            self._lock.notify_all()
+            
+    def flush(self):
+        """
+        Waits for queued saves to be written. Call before shutting down.
+        """
+        with self._lock:
+            while self._pending is not None or self._busy:
+                self._lock.wait()
+            thread = self._thread
+        #The writer exits once idle. Wait for that too, so it isn't still running when Python shuts down.
+        if thread is not None:
+            thread.join()
+                    
+    def _run(self):
+        """
+        Writer thread. Always writes the newest queued tileset.
+        """
+        while True:
+            with self._lock:
+                if self._pending is None:
+                    #Nothing left to write. The next save starts a new thread.
+                    #Not left waiting, which would fail noisily when Python shuts down.
+                    self._thread = None
+                    return
+                filename, atlas, rows, keys, ids, checksum = self._pending
+                self._pending = None
+                self._busy = True
+            try:
+                self._write(filename, atlas, rows, keys, ids, checksum)
+            except Exception as inst:
+                print("Error saving tileset image %s: %s" % (filename, inst))
+            with self._lock:
+                self._busy = False
+                self._lock.notify_all()
+                
+    def _write(self, filename, atlas, rows, keys, ids, checksum):
+        """
+        Writes to a temporary file and renames it so a partly written tileset is never left behind.
+        """
+        if checksum is None:
+            img_io = StringIO()
+            Image.fromarray(atlas[:rows]).save(img_io, 'png', optimize = True)
+            data = img_io.getvalue()
+            checksum = hashlib.md5(data).digest()
+            
+            path = os.path.join(self.directory, filename)
+            temp = path + ".tmp"
+            with open(temp, 'wb') as f:
+                f.write(data)
+            _replaceFile(temp, path)
+        
+        if keys is not None:
+            #Written after the image, and only valid for these exact bytes
+            _writeIndex(os.path.join(self.directory, _indexFilename(filename)), checksum, self.tile_x, self.tile_y, keys, ids, atlas[:rows])
+            
+        if self.current is not None and self.current != filename:
+            for old in (self.current, _indexFilename(self.current)):
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except OSError:
+                    pass
+        self.current = filename
 
 class Tileset:
     """
     Holds details for the tileset.
     """
     
-    def __init__(self, filename, tile_x, tile_y, array = False, debug = False):        
+    def __init__(self, filename, tile_x, tile_y, array = False, debug = False, fuzzy = 0):        
         
         self.tile_x = tile_x
         self.tile_y = tile_y
@@ -42,26 +345,68 @@ class Tileset:
         self.screen_y = 0
         
         self.fullMap = []
-        self.prevDifMap = []
         
         if filename is None:
             #fake a filename
             self.filename = "%02dx%02d-%05d.png" % (self.tile_x, self.tile_y, 0)
-            img = None
+            data = None
         else:
             self.filename = filename
-            img = Image.open("./tilesets/%s" % filename)
+            with open("./tilesets/%s" % filename, 'rb') as f:
+                data = f.read()
             
         self.debug = debug        
-        self.tileset = img      
+        
+        #Tileset image as an array of tile slots. Grown a chunk of rows at a time.
+        self._atlas = numpy.zeros((0, _atlasWidth * self.tile_x, 3), dtype = numpy.uint8)
+        self._atlasImage = None
+        self.saver = TilesetSaver(self.tile_x, self.tile_y)
+        
+        #Tiles are only ever appended, so the tile count doubles as the tileset version
+        self.version = 0
+        self._payload = None
+        self._payloadVersion = None
+        self._payload64 = None
+        self._payload64Version = None
         
         self.tileDict = {}
+        self._keyWeights = {}
+        self._keyScratch = {}
+        self._sortedKeys = numpy.zeros(0, dtype = numpy.uint64)
+        self._sortedIds = numpy.zeros(0, dtype = numpy.int64)
+        self._indexDirty = False
+        
+        #Previous frame, kept to skip tiles that didn't change. Raw bytes for PIL images, a FrameDiff for arrays.
+        self._prevFrame = None
+        self._frameDiff = FrameDiff()
+        #Whether the last parsed frame was different from the one before it
+        self.frameChanged = True
+        #Seconds spent adding new tiles during the last parse
+        self.learnTime = 0.0
+        #Tiles added since loading
+        self.tilesLearned = 0
+        self._prevSize = None
+        self._prevIds = None
+        
+        #Unseen tiles whose pixels are all within this many levels of a known tile reuse its id. 0 turns it off.
+        self.fuzzyThreshold = fuzzy
+        #Keys of near matches and the id they reuse. Not saved, they are matched again next run.
+        self.nearDict = {}
+        self._signatures = numpy.zeros((0, 3 * _signatureGrid ** 2), dtype = numpy.float32)
+        self._signatureMeans = numpy.zeros(0, dtype = numpy.float32)
+        self._signatureOrder = numpy.zeros(0, dtype = numpy.int64)
         self._parseFilename(self.filename)
-        if img is not None:
-            if array:
-                self._loadSet(array = True)
-            else:
-                self._loadSet()
+        if data is not None:
+            #Saved keys, ids and pixels, if they match this exact image. The png is only decoded without them.
+            checksum = hashlib.md5(data).digest()
+            index = _readIndex("./tilesets/%s" % _indexFilename(filename), checksum, self.tile_x, self.tile_y, self.tileCount)
+            self._loadSet(Image.open(StringIO(data)) if index is None else None, index = index)
+            self.saver.current = filename
+            if index is None and self.tileCount > 0:
+                #Older tileset, or a stale index. Write one so the next load is fast.
+                self._rebuildIndex()
+                rows = (self.tileCount + _atlasWidth - 1) / _atlasWidth
+                self.saver.save(filename, self._atlas, rows * self.tile_y, self._sortedKeys, self._sortedIds, checksum)
         
     def _parseFilename(self, filename):
         """
@@ -85,65 +430,56 @@ class Tileset:
             print("Error with tileset filename. Exiting.")
             sys.exit()
         
-    def _loadSet(self, img = None, array = False, verbose = True):
+    def _loadSet(self, img, index = None, verbose = True):
         """
         Creates a dictionary from the tileset image.
+        If an index (sorted keys, ids and tileset pixels) is given, its pixels are used instead of 'img' and
+        tiles aren't fingerprinted.
         """
-        
-        if img is None:
-            img = self.tileset
-            
-        if array:
-            img_array = numpy.array(img)
-        
-        image_x, image_y = img.size
+        if index is None:
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            image_x, image_y = img.size
+            img_array = numpy.frombuffer(img.tobytes(), dtype = numpy.uint8).reshape(image_y, image_x, 3)
+        else:
+            sortedKeys, sortedIds, img_array = index
+            image_y, image_x = img_array.shape[:2]
         
         tiles_x = image_x / self.tile_x
         tiles_y = image_y / self.tile_y
         
-        #tile number i.e. "position"
-        t = 0
+        #Once max tiles in tileset is reached, end the load process
+        tiles = self._tileBlocks(img_array, tiles_x, tiles_y).reshape(-1, self.tile_y, self.tile_x, 3)[:self.tileCount]
         
         #reset tileDict
         self.tileDict.clear()
+        self.tileCount = 0
+        self._atlas = self._atlas[:0]
         
-        for y_start in range(tiles_y):
-            for x_start in range(tiles_x):
-                #Once max tiles in tileset is reached, end the load process
-                if t >= self.tileCount:
-                    break
-                if array:
-                    tile = img_array[y_start * self.tile_y: y_start * self.tile_y + self.tile_y, x_start * self.tile_x: x_start * self.tile_x + self.tile_x]
-                else:
-                    tile = img.crop((x_start * self.tile_x, y_start * self.tile_y, x_start * self.tile_x + self.tile_x, y_start * self.tile_y + self.tile_y))       
-                
-                #Use the hash of the tile as a key to insure that it is unique
-                tile_hash = self._imageHash(tile)
-                
-                if tile_hash in self.tileDict:
-                    #It would be bad to find a duplicate in the tileset.
-                    print("Error: Found duplicate tile in tileset. Exiting.")
-                    print("t=%d" % t)
-                    sys.exit()
-                else:
-                    self.tileDict[tile_hash] = t
-                        
-                t += 1
-                        
-        self.tileset = img
+        if index is None:
+            keys = self._tileKeys(tiles)
+        else:
+            keys = numpy.empty(len(tiles), dtype = numpy.uint64)
+            keys[sortedIds] = sortedKeys
+        self._appendTiles(tiles, keys)
+        
+        if len(self.tileDict) != self.tileCount:
+            #It would be bad to find a duplicate in the tileset.
+            print("Error: Found duplicate tile in tileset. Exiting.")
+            sys.exit()
+            
         if verbose:
-            prettyConsole.console('log', "Tileset loaded: %s with %d tiles" % (self.filename, t))
+            prettyConsole.console('log', "Tileset loaded: %s with %d tiles%s" % (self.filename, self.tileCount, " (indexed)" if index is not None else ""))
             
     def _addTileToSet(self, img, array = False, verbose = True):
         """
         Adds new tile to tileset.
         """
-        if array:
-            img = Image.fromarray(img.astype('uint8')).convert('RGB')
-        
+        if not array:
+            img = numpy.asarray(img)
         
         #Check that proposed tile matches the tile size of the set
-        pTile_x, pTile_y = img.size
+        pTile_y, pTile_x = img.shape[:2]
         if (pTile_x == self.tile_x) and (pTile_y == self.tile_y):
             pass
         else:
@@ -153,60 +489,70 @@ class Tileset:
             exit()
             return
             
-        if self.tileset is not None:
-            image_x, image_y = self.tileset.size
-        else:
-            image_x = self.tile_x
-            image_y = self.tile_y
+        tiles = img[numpy.newaxis]
+        self._appendTiles(tiles, self._tileKeys(tiles))
         
-        tiles_x = image_x / self.tile_x
-        tiles_y = image_y / self.tile_y
-        
-        #Number of tiles to place across the width of the tileset image
-        maxTiles_x = 32
-        
-        #Check if a new row needs to be created in the image
-        if self.tileCount + 1 > maxTiles_x * tiles_y:
-            #need to add another row to tileset image
-            newTileSet = Image.new(self.tileset.mode, (maxTiles_x * self.tile_x, tiles_y * self.tile_y + self.tile_y), "white")
-        else:
-            #No need to add new row
-            if self.tileset is not None:
-                newTileSet = Image.new(self.tileset.mode, (maxTiles_x * self.tile_x, tiles_y * self.tile_y), "white")
-            else:
-                newTileSet = Image.new("RGB", (maxTiles_x * self.tile_x, tiles_y * self.tile_y), "white")
-        
-        #copy existing tileset image onto new blank image
-        if self.tileset is not None:
-            newTileSet.paste(self.tileset, (0, 0))
-        
-        #paste new tile into the proper location
-        if self.tileset is not None:
-            newTilePosition = self.tileCount
-        else:
-            #first tile goes in first spot
-            newTilePosition = 0
+    def _appendTiles(self, tiles, keys):
+        """
+        Appends tiles to the end of the tileset. Existing tiles are never moved, so this is O(1) per tile.
+        """
+        first = self.tileCount
+        ids = numpy.arange(first, first + len(tiles))
+        
+        #Grow the tileset array when the slots run out. Doubling keeps the copies amortized.
+        rows = (first + len(tiles) + _atlasWidth - 1) / _atlasWidth
+        capacity = len(self._atlas) / self.tile_y
+        if rows > capacity:
+            grown = numpy.empty((max(rows, 2 * capacity) * self.tile_y, _atlasWidth * self.tile_x, 3), dtype = numpy.uint8)
+            #Unused slots are white
+            grown.fill(255)
+            grown[:len(self._atlas)] = self._atlas
+            self._atlas = grown
             
-        new_x = newTilePosition % maxTiles_x * self.tile_x
-        new_y = newTilePosition / maxTiles_x * self.tile_y
-        newTileSet.paste(img, (new_x, new_y))
+        slots = self._tileBlocks(self._atlas, _atlasWidth, len(self._atlas) / self.tile_y)
+        slots[ids / _atlasWidth, ids % _atlasWidth] = tiles
         
-        filename = "%02dx%02d-%05d.png" % (self.tile_x, self.tile_y, newTilePosition)
+        self.tileDict.update(zip(keys.tolist(), ids.tolist()))
+        self.tileCount += len(tiles)
+        self.version = self.tileCount
+        self.filename = "%02dx%02d-%05d.png" % (self.tile_x, self.tile_y, self.tileCount)
+        self._indexDirty = True
+        self._atlasImage = None
         
-        #reload new tileset
-        self.tileCount += 1
-        self.filename = filename
-        self._loadSet(newTileSet, array, verbose)
+    def getImage(self):
+        """
+        Returns the tileset image. Only built from the tileset array when tiles have been added.
+        """
+        if self._atlasImage is None:
+            if self.tileCount == 0:
+                #One row of free slots
+                self._atlasImage = Image.new("RGB", (_atlasWidth * self.tile_x, self.tile_y), "white")
+            else:
+                rows = (self.tileCount + _atlasWidth - 1) / _atlasWidth
+                self._atlasImage = Image.fromarray(self._atlas[:rows * self.tile_y])
+        return self._atlasImage
     
     def _saveSet(self):
         """
-        Saves tileset image to disk
+        Saves tileset image to disk in the background. An empty tileset isn't saved.
         """
+        if self.tileCount == 0:
+            return
         
         prettyConsole.console('log', "Saving new tileset image: %s" % self.filename)
-        self.tileset.save("./tilesets/%s" % self.filename, optimize = True )
+        #Filled slots are never written again, so the writer can use the array without a copy
+        rows = (self.tileCount + _atlasWidth - 1) / _atlasWidth
+        if self._indexDirty:
+            self._rebuildIndex()
+        self.saver.save(self.filename, self._atlas, rows * self.tile_y, self._sortedKeys, self._sortedIds)
         
-    def parseImage(self, img, returnFullMap = True):
+    def flush(self):
+        """
+        Waits until the tileset has been written to disk.
+        """
+        self.saver.flush()
+        
+    def parseImage(self, img):
         """
         Parses an image. Returns list of tile positions in map.
         """
@@ -241,127 +587,331 @@ class Tileset:
             #Do this here so that each new tile isn't saved.
             self._saveSet()
                     
-        if returnFullMap:
-            #Update fullMap
-            self.fullMap[:] = []
-            self.fullMap.extend(tileMap)
-            return tileMap
-        else:
-            return self._tileMapDifference(tileMap)
+        #Update fullMap
+        self.fullMap[:] = []
+        self.fullMap.extend(tileMap)
+        return tileMap
         
-    def _tileMapDifference(self, newMap):
+    def parseImageArray(self, img, dirty = None):
         """
-        Compares newMap to latest fullMap and prevDifMap. Returns newMap with '-2' in positions that didn't change.
+        Parses an image as an array. Returns list of tile positions in map.
         """
+        tileMap = self.parseImageIds(img, dirty).tolist()
         
-        #return newMap
-        try:
-            if len(newMap) != len(self.fullMap):
-                #Map may have changed dimensions
-                return newMap
-            else:
-                differenceMap = []
-                for i in xrange(len(newMap)):
-                    rowDif = []
-                    for j in xrange(len(newMap[0])):
-                        if newMap[i][j] == self.fullMap[i][j] and self.prevDifMap == -2:
-                            rowDif.append(-2)
-                        else:
-                            rowDif.append(newMap[i][j])
-                            #differenceMap.append(newMap[i])
-                    differenceMap.append(rowDif)
-                
-                #Update the saved difMap
-                self.prevDifMap[:] = []
-                self.prevDifMap.extend(differenceMap)
-                return differenceMap
-        except:
-            prettyConsole.console('log', "Difference map exception")
-            return newMap
+        #Update fullMap
+        self.fullMap[:] = []
+        self.fullMap.extend(tileMap)
+        return tileMap
         
-
-    def parseImageArray(self, img, returnFullMap = True):
+    def parseImageIds(self, img, dirty = None):
         """
-        Parses an image as an array. Returns list of tile positions in map.
+        Parses an image as an array. Returns a (tiles_y, tiles_x) array of tile ids, -1 for tiles added this frame.
+        Only tiles that changed since the last frame are fingerprinted.
+        'img' is a PIL image or a (height, width, 3) array, which can be a view and isn't copied.
+        For arrays, 'dirty' can list the (x, y, width, height) rectangles redrawn since the last frame. Tiles outside them aren't looked at.
         """
-        #img_arr = numpy.ascontiguousarray(img)
-        img_arr = numpy.array(img)
-        tileMap = []
-        addTilesDict = {}
-        tileSetChanged = False        
-        image_x, image_y = img.size
+        self.learnTime = 0.0
+        if isinstance(img, numpy.ndarray):
+            img_arr = img
+            image_y, image_x = img.shape[:2]
+            raw = None
+        else:
+            image_x, image_y = img.size
+            #Wrapping the raw bytes is much cheaper than numpy.array(img)
+            raw = img.tobytes()
+            img_arr = numpy.frombuffer(raw, dtype = numpy.uint8).reshape(image_y, image_x, 3)
         self.screen_x = image_x
         self.screen_y = image_y
         
         tiles_x = image_x / self.tile_x
         tiles_y = image_y / self.tile_y
         
-        # from: http://stackoverflow.com/questions/8070349/using-numpy-stride-tricks-to-get-non-overlapping-array-blocks
-        sz = img_arr.itemsize
-        h,w = image_y, image_x
-        bh,bw = self.tile_y, self.tile_x
-        shape = numpy.array([h/bh, w/bw, bh, bw, 3])
-        strides = sz*numpy.array([w*bh*3,bw*3,w*3,3,1])
-
-        blocks=numpy.lib.stride_tricks.as_strided(img_arr, shape=shape, strides=strides)
+        tiles = self._tileBlocks(img_arr, tiles_x, tiles_y)
+        if raw is None:
+            changed = self._frameDiff.changedTiles(img_arr, self.tile_x, self.tile_y, dirty)
+        else:
+            changed = changedTiles(raw, self._prevFrame if self._prevSize == (image_x, image_y) else None, image_x, image_y, self.tile_x, self.tile_y)
+            self._frameDiff.reset()
+        self.frameChanged = changed is None or len(changed) > 0
+        
+        if changed is None:
+            #Nothing to compare against, fingerprint every tile
+            keys = self._tileKeys(tiles)
+            found = self._lookupKeys(keys)
+            ids = found
+        elif len(changed) == 0:
+            #Same frame as last time
+            keys = found = numpy.zeros(0, dtype = numpy.int64)
+            ids = self._prevIds
+        else:
+            keys = self._tileKeys(tiles[changed / tiles_x, changed % tiles_x])
+            found = self._lookupKeys(keys)
+            ids = self._prevIds.copy()
+            ids[changed] = found
+        
+        missing = found < 0
+        if missing.any():
+            positions = numpy.flatnonzero(missing)
+            if changed is not None:
+                positions = changed[positions]
+            learned, added = self._learnTiles(tiles[positions / tiles_x, positions % tiles_x], keys[missing])
+            
+            #Remember the new ids so unchanged tiles don't stay at -1
+            ids = ids.copy()
+            ids[positions] = learned
+            #Tiles added this frame are still sent as -1
+            mapIds = ids.copy()
+            mapIds[positions[added]] = -1
+        else:
+            mapIds = ids
+            
+        self._prevFrame = raw
+        self._prevSize = (image_x, image_y)
+        self._prevIds = ids
         
-        a = blocks.reshape([-1,self.tile_y,self.tile_x,3])
+        return mapIds.reshape(tiles_y, tiles_x)
+            
+    def tileIds(self, tiles):
+        """
+        Returns the id of each tile in a (count, tile_y, tile_x, 3) array. Unseen tiles are added to the tileset.
+        """
+        keys = self._tileKeys(tiles)
+        ids = self._lookupKeys(keys)
         
-        row = []
-        i = 0
+        missing = ids < 0
+        if missing.any():
+            ids[missing] = self._learnTiles(tiles[missing], keys[missing])[0]
+        return ids
         
-        for c in a:
-            tile_hash = self._imageHash(c)
+    def _learnTiles(self, tiles, keys):
+        """
+        Finds ids for tiles that weren't in the tileset. Near matches reuse an existing id, the rest are added.
+        Returns the ids and which tiles were added.
+        """
+        start = stats.monotonic()
+        #Look at each unseen tile once, in the order it first appears on screen
+        newKeys, first, inverse = numpy.unique(keys, return_index = True, return_inverse = True)
+        order = numpy.argsort(first)
+        newKeys = newKeys[order]
+        newTiles = tiles[first[order]]
+        
+        if self.fuzzyThreshold > 0:
+            newIds = self._nearestTiles(newTiles)
+            near = newIds >= 0
+            self.nearDict.update(zip(newKeys[near].tolist(), newIds[near].tolist()))
+        else:
+            newIds = numpy.full(len(newKeys), -1, dtype = numpy.int64)
             
-            if tile_hash in self.tileDict:
-                row.append(self.tileDict[tile_hash])
-            else:
-                row.append(-1)
-                if tile_hash in addTilesDict:
-                    pass
-                else:
-                    addTilesDict[tile_hash] = c
-                tileSetChanged = True
-                
-            i += 1
-            if i == tiles_x:
-                tileMap.append(row)
-                row = []
-                i = 0       
-                
-        if tileSetChanged:
+        added = newIds < 0
+        if added.any():
+            newIds[added] = numpy.arange(self.tileCount, self.tileCount + added.sum())
+            self._appendTiles(newTiles[added], newKeys[added])
+            self.tilesLearned += int(added.sum())
             #If new tiles were added, save the file to disk.
             #Do this here so that each new tile isn't saved.
-            for k in addTilesDict.keys():
-                self._addTileToSet(addTilesDict[k], array = True, verbose = False)
             self._saveSet()
-                    
-        if returnFullMap:
-            #Update fullMap
-            self.fullMap[:] = []
-            self.fullMap.extend(tileMap)
-            return tileMap
-        else:
-            return self._tileMapDifference(tileMap)
+            
+        #Back to the original order
+        unsort = numpy.empty_like(order)
+        unsort[order] = numpy.arange(len(order))
+        self.learnTime += stats.monotonic() - start
+        return newIds[unsort][inverse], added[unsort][inverse]
+        
+    def _nearestTiles(self, tiles):
+        """
+        Returns the id of the closest known tile within fuzzyThreshold of each tile, or -1 if there isn't one.
+        Distance is the largest difference of any pixel value.
+        """
+        ids = numpy.full(len(tiles), -1, dtype = numpy.int64)
+        self._updateSignatures()
+        if self.tileCount == 0:
+            return ids
+            
+        threshold = self.fuzzyThreshold
+        signatures = self._tileSignatures(tiles)
+        means = signatures.mean(axis = 1)
+        slots = self._tileBlocks(self._atlas, _atlasWidth, len(self._atlas) / self.tile_y)
+        
+        #A cell mean or the mean of all cells can't move further than the pixels did,
+        #so both rule out tiles without missing a match.
+        low = numpy.searchsorted(self._signatureMeans, means - threshold, side = 'left')
+        high = numpy.searchsorted(self._signatureMeans, means + threshold, side = 'right')
+        for i in xrange(len(tiles)):
+            candidates = self._signatureOrder[low[i]:high[i]]
+            if len(candidates) == 0:
+                continue
+            close = numpy.abs(self._signatures[candidates] - signatures[i]).max(axis = 1) <= threshold
+            candidates = candidates[close]
+            if len(candidates) == 0:
+                continue
+                
+            known = slots[candidates / _atlasWidth, candidates % _atlasWidth].astype(numpy.int16)
+            distance = numpy.abs(known - tiles[i]).reshape(len(candidates), -1).max(axis = 1)
+            best = distance.argmin()
+            if distance[best] <= threshold:
+                ids[i] = candidates[best]
+        return ids
+        
+    def _tileSignatures(self, tiles):
+        """
+        Returns the mean colour of each cell of a grid over each tile, as a (count, cells * 3) array.
+        """
+        rows = numpy.arange(_signatureGrid) * self.tile_y / _signatureGrid
+        cols = numpy.arange(_signatureGrid) * self.tile_x / _signatureGrid
+        sums = numpy.add.reduceat(tiles.astype(numpy.float32), rows, axis = 1)
+        sums = numpy.add.reduceat(sums, cols, axis = 2)
+        #Pixels in each cell. Cells differ by one pixel when the tile doesn't divide evenly.
+        sizes = numpy.diff(numpy.append(rows, self.tile_y))[:, numpy.newaxis] * numpy.diff(numpy.append(cols, self.tile_x))
+        return (sums / sizes[:, :, numpy.newaxis]).reshape(len(tiles), -1)
+        
+    def _updateSignatures(self):
+        """
+        Adds signatures for tiles added since the last near match, and re-sorts the tiles by mean colour.
+        """
+        done = len(self._signatures)
+        if done == self.tileCount:
+            return
+        ids = numpy.arange(done, self.tileCount)
+        slots = self._tileBlocks(self._atlas, _atlasWidth, len(self._atlas) / self.tile_y)
+        self._signatures = numpy.concatenate([self._signatures, self._tileSignatures(slots[ids / _atlasWidth, ids % _atlasWidth])])
+        means = self._signatures.mean(axis = 1)
+        self._signatureOrder = numpy.argsort(means)
+        self._signatureMeans = means[self._signatureOrder]
+        
+    def _tileBlocks(self, img_arr, tiles_x, tiles_y):
+        """
+        Returns a (tiles_y, tiles_x, tile_y, tile_x, 3) view of the whole tiles in an image array.
+        """
+        # Same blocks as: http://stackoverflow.com/questions/8070349/using-numpy-stride-tricks-to-get-non-overlapping-array-blocks
+        # Splitting each axis in two never needs a copy.
+        blocks = img_arr[:tiles_y * self.tile_y, :tiles_x * self.tile_x]
+        blocks = blocks.reshape(tiles_y, self.tile_y, tiles_x, self.tile_x, 3)
+        return blocks.swapaxes(1, 2)
+        
+    def _tileKeys(self, tiles):
+        """
+        Reduces each tile to a 64-bit key. Takes any array with tiles along the first axis.
+        """
+        count = tiles.shape[0] * tiles.shape[1] if tiles.ndim == 5 else tiles.shape[0]
+        tileBytes = self.tile_x * self.tile_y * 3
+        #Pad each tile out to whole 32-bit words
+        words = (tileBytes + 3) / 4
+        flat, wide = self._keyBuffers(count, words)
+        
+        #Copy the tiles into the byte buffer through a view with the same shape
+        tileView = flat[:, :tileBytes]
+        tileView.shape = tiles.shape
+        tileView[...] = tiles
+        wide[...] = flat.view('<u4')
+        
+        weights = self._keyWeights.get(words)
+        if weights is None:
+            weights = _fingerprintWeights(words)
+            self._keyWeights[words] = weights
+            
+        #Weighted sum of the words, wrapping at 64 bits.
+        return numpy.dot(wide, weights)
+        
+    def _keyBuffers(self, count, words):
+        """
+        Returns scratch buffers for _tileKeys. Reused between frames so the large buffers aren't reallocated.
+        """
+        flat, wide = self._keyScratch.get(words, (None, None))
+        if flat is None or len(flat) < count:
+            flat = numpy.zeros((count, words * 4), dtype = numpy.uint8)
+            wide = numpy.empty((count, words), dtype = numpy.uint64)
+            self._keyScratch[words] = (flat, wide)
+        return flat[:count], wide[:count]
+        
+    def _rebuildIndex(self):
+        """
+        Rebuilds the sorted key array used to look up a whole frame of keys at once.
+        """
+        count = len(self.tileDict)
+        keys = numpy.fromiter(self.tileDict.iterkeys(), dtype = numpy.uint64, count = count)
+        ids = numpy.fromiter(self.tileDict.itervalues(), dtype = numpy.int64, count = count)
+        order = numpy.argsort(keys)
+        self._sortedKeys = keys[order]
+        self._sortedIds = ids[order]
+        self._indexDirty = False
+        
+    def _lookupKeys(self, keys):
+        """
+        Returns the tile id for each key, or -1 if the tile isn't in the tileset.
+        """
+        if self._indexDirty:
+            self._rebuildIndex()
+            
+        if len(self._sortedKeys) == 0:
+            return numpy.full(len(keys), -1, dtype = numpy.int64)
+            
+        pos = numpy.searchsorted(self._sortedKeys, keys)
+        pos[pos == len(self._sortedKeys)] = 0
+        found = self._sortedKeys[pos] == keys
+        ids = numpy.where(found, self._sortedIds[pos], -1)
+        
+        if self.nearDict:
+            #Near matches from earlier frames
+            for i in numpy.flatnonzero(~found):
+                ids[i] = self.nearDict.get(int(keys[i]), -1)
+        return ids
         
     def _imageHash(self, img):
         """
         Returns a hash of the image.
         """        
-        #Hash is fast
-        return hash(img.tostring())
-        
-        #murmur3 is fastest but not a lot faster than Hash
-        #return mmh3.hash(img.tostring())
+        #Same key as the whole frame parse, so both parse methods share tileDict
+        return int(self._tileKeys(numpy.asarray(img)[numpy.newaxis])[0])
         
     def wampSend(self):
         """
         Converts tileset image to byte string so that it can be send via WAMP.
+        Only re-encoded when the tileset version changes.
+        """
+        if self._payload64Version != self.version:
+            #can't send binary data directly. Base64 encode first.
+            self._payload64 = self.wampSendRaw().encode("base64")
+            self._payload64Version = self.version
+        return self._payload64
+        
+    def wampSendRaw(self):
+        """
+        Returns the tileset png for sessions that can send binary data.
+        Only re-encoded when the tileset version changes.
+        """
+        if self._payloadVersion != self.version:
+            img_io = StringIO()
+            self.getImage().save(img_io, 'png', optimize = True)
+            self._payload = img_io.getvalue()
+            self._payloadVersion = self.version
+        return self._payload
+        
+    def wampSendDelta(self, version, raw = False):
         """
-        img_io = StringIO()
-        self.tileset.save(img_io, 'png', optimize = True)
-        img_io.seek(0)
-        #return img_io
-        #can't send binary data directly. Base64 encode first.
-        return img_io.getvalue().encode("base64")
-        
\ No newline at end of file
+        Returns the tiles added since 'version' so that viewers don't download the whole tileset again.
+        Tile ids run from 'first' to 'first' + 'count' - 1. 'tiles' is the raw RGB pixels of each tile in turn,
+        zlib compressed and base64 encoded. If the gap is too large, 'full' holds the wampSend image instead.
+        With 'raw', 'tiles' and 'full' are bytes instead of base64.
+        """
+        delta = {'version': self.version, 'tile_x': self.tile_x, 'tile_y': self.tile_y}
+        
+        try:
+            version = int(version)
+        except (TypeError, ValueError):
+            version = -1
+            
+        if version <= 0 or version > self.version or self.version - version > _maxDeltaTiles:
+            #Viewer has nothing useful (or a different tileset), send it all
+            delta['full'] = self.wampSendRaw() if raw else self.wampSend()
+            return delta
+            
+        ids = numpy.arange(version, self.version)
+        slots = self._tileBlocks(self._atlas, _atlasWidth, len(self._atlas) / self.tile_y)
+        tiles = slots[ids / _atlasWidth, ids % _atlasWidth]
+        
+        delta['first'] = version
+        delta['count'] = len(ids)
+        delta['tiles'] = zlib.compress(tiles.tostring())
+        if not raw:
+            delta['tiles'] = delta['tiles'].encode("base64")
+        return delta
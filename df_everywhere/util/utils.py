@@ -23,6 +23,7 @@ except:
     from PIL import ImageChops
 
 import os
+import numpy
     
 
 def win_get_windows_bytitle(title_text, exact = False):    
@@ -165,9 +166,25 @@ def linux_get_windows_bytitle(title_text, exact = False):
             if title_text in win.get_name():
                 return win
     
-def linux_screenshot(wnck_win = None, debug = False):
+def linux_get_window_byxid(xid):
+    """
+    Finds a linux (Gtk) window by X window id. Returns window, or None.
+    """
+    
+    import gtk, wnck
+    
+    default = wnck.screen_get_default()
+    
+    while gtk.events_pending():
+        gtk.main_iteration(False)
+    default.force_update()
+    
+    return wnck.window_get(xid)
+    
+def linux_screenshot(wnck_win = None, debug = False, tracker = None):
     """
     Takes a screenshot of the given window on linux using Gtk.
+    With an xcapture.WindowTracker, the window is only brought to the front while something covers it.
     """
     
     import gtk, wnck
@@ -177,18 +194,27 @@ def linux_screenshot(wnck_win = None, debug = False):
     
     root_win = gtk.gdk.get_default_root_window()
     w = wnck_win
-    w.activate(int(time.time()))
-    #Should not need to sleep, but works for now.
-    #time.sleep(1)
-    #Maybe just needs a flush()?
-    
-    #Check to see if a window is above the target window
-    if w.is_below():
-        #If it is, don't bother taking a screen shot.
-        return None
+    if tracker is not None:
+        tracker.readEvents()
+        if tracker.window is None:
+            return None
+    if tracker is None or tracker.obscured is not False:
+        w.activate(int(time.time()))
+        #Should not need to sleep, but works for now.
+        #time.sleep(1)
+        #Maybe just needs a flush()?
+        
+        #Check to see if a window is above the target window
+        if w.is_below():
+            #If it is, don't bother taking a screen shot.
+            return None
+        if tracker is not None:
+            tracker.raised()
 
-    pb1 = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB,False,8,w.get_client_window_geometry()[2], w.get_client_window_geometry()[3])
-    pb2 = pb1.get_from_drawable(root_win,root_win.get_colormap(),w.get_client_window_geometry()[0],w.get_client_window_geometry()[1],0,0,w.get_client_window_geometry()[2],w.get_client_window_geometry()[3])
+    #Geometry is read once a frame, not once per use
+    x, y, width, height = w.get_client_window_geometry()
+    pb1 = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB,False,8,width, height)
+    pb2 = pb1.get_from_drawable(root_win,root_win.get_colormap(),x,y,0,0,width,height)
     if (pb2 != None):
         if debug:
             pb2.save("screenshot_gtk.png","png")
@@ -325,4 +351,42 @@ def trim(im, debug = False):
         print(bbox)
     if bbox:
         return im.crop(bbox)
-        
\ No newline at end of file
+
+def trimBox(arr, bbox = None):
+    """
+    Returns the (left, top, right, bottom) box around everything that isn't black in a (height, width, 3) array,
+    or None if it is all black. A box from the last frame can be passed in 'bbox'. If only black is outside it
+    and each of its edges still touches something that isn't black, it is returned without searching the whole frame.
+    """
+    if bbox is not None:
+        left, top, right, bottom = bbox
+        height, width = arr.shape[:2]
+        if (right <= width and bottom <= height and
+                arr[top].any() and arr[bottom - 1].any() and arr[top:bottom, left].any() and arr[top:bottom, right - 1].any() and
+                not arr[:top].any() and not arr[bottom:].any() and not arr[top:bottom, :left].any() and not arr[top:bottom, right:].any()):
+            return bbox
+            
+    mask = arr.any(axis = 2)
+    rows = numpy.flatnonzero(mask.any(axis = 1))
+    if len(rows) == 0:
+        return None
+    cols = numpy.flatnonzero(mask.any(axis = 0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+def trimArray(arr, bbox = None, debug = False):
+    """
+    Same as trim for a (height, width, 3) array. Returns a view of the array, nothing is copied.
+    'bbox' is a box from trimBox, found here if not given.
+    """
+    if arr is None:
+        return None
+    if bbox is None:
+        bbox = trimBox(arr)
+        if bbox is None:
+            return None
+    if debug:
+        print("Original size:")
+        print(arr.shape[1::-1])
+        print("bbox:")
+        print(bbox)
+    return arr[bbox[1]:bbox[3], bbox[0]:bbox[2]]
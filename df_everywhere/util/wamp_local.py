@@ -24,8 +24,61 @@ from autobahn.twisted.wamp import ApplicationSession
 from autobahn.twisted.websocket import WampWebSocketClientFactory
 from autobahn.wamp import types
 from autobahn.wamp import auth
+from autobahn.wamp import message
+from autobahn.wamp.serializer import JsonSerializer
 
 
+def serializers(binary = True):
+    """
+    Returns the serializers to offer, best first.
+    MessagePack and CBOR carry binary data as is. JSON is the fallback for old viewers.
+    """
+    offered = []
+    if binary:
+        try:
+            from autobahn.wamp.serializer import MsgPackSerializer
+            offered.append(MsgPackSerializer())
+        except ImportError:
+            pass
+        try:
+            from autobahn.wamp.serializer import CBORSerializer
+            offered.append(CBORSerializer())
+        except ImportError:
+            pass
+    offered.append(JsonSerializer())
+    return offered
+
+def bufferedBytes(session):
+    """
+    Returns the number of bytes written to a session's connection that haven't been sent yet.
+    """
+    try:
+        #Twisted keeps unsent data in dataBuffer (from offset on) and in a list of newer writes
+        transport = session._transport.transport
+        return len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+    except AttributeError:
+        return 0
+      
+def countPublishedBytes(session, counter):
+    """
+    Calls counter(topic, bytes) with the serialized size of each message the session publishes.
+    Sizes come from the serializer as it writes each message, so nothing is serialized twice.
+    """
+    try:
+        serializer = session._transport._serializer
+    except AttributeError:
+        return
+    if getattr(serializer, 'countingBytes', False):
+        #Serializers are kept by the factory between reconnects. Only count once.
+        return
+    serializer.countingBytes = True
+    serialize = serializer.serialize
+    def counted(msg):
+        data = serialize(msg)
+        if isinstance(msg, message.Publish):
+            counter(msg.topic, len(data[0]))
+        return data
+    serializer.serialize = counted
       
 class SubpubTileset(ApplicationSession):
     """
@@ -49,6 +102,11 @@ class SubpubTileset(ApplicationSession):
             raise Exception("don't know how to compute challenge for authmethod {}".format(challenge.method))
     
     def onJoin(self, details):
+        #Whether bytes can be sent without base64 encoding them first
+        try:
+            self.binaryPayloads = self._transport._serializer.SERIALIZER_ID != u"json"
+        except AttributeError:
+            self.binaryPayloads = False
         if not self in self.factory._myConnection:
             self.factory._myConnection.append(self)
             
@@ -79,8 +137,8 @@ def wampServ(wampAddress, wampPort, wampDebug = False):
     Code modified from WAMP documentation.
     """
     from twisted.internet.endpoints import serverFromString
-    from autobahn.wamp.router import RouterFactory
-    from autobahn.twisted.wamp import RouterSessionFactory
+    #The Twisted router factory: the generic one in autobahn.wamp.router makes routers without a broker or dealer
+    from autobahn.twisted.wamp import RouterFactory, RouterSessionFactory
     from autobahn.twisted.websocket import WampWebSocketServerFactory
     
     ## create a WAMP router factory        
@@ -90,17 +148,18 @@ def wampServ(wampAddress, wampPort, wampDebug = False):
     session_factory = RouterSessionFactory(router_factory)
 
     ## create a WAMP-over-WebSocket transport server factory        
-    transport_factory = WampWebSocketServerFactory(session_factory, wampAddress, debug = wampDebug)
+    transport_factory = WampWebSocketServerFactory(session_factory, wampAddress, serializers = serializers(), debug = wampDebug)
     transport_factory.setProtocolOptions(failByDrop = False)
 
     ## Start websocket server
     server = serverFromString(reactor, wampPort)
     server.listen(transport_factory)
     
-def wampClient(wampAddress, wampClientEndpoint, topic, key):
+def wampClient(wampAddress, wampClientEndpoint, topic, key, binary = True):
     """
     Sets up an Autobahn|python WAMPv2 client.
     Code modified from WAMP documentation.
+    With 'binary', a binary serializer is used if the router supports one.
     """
     
     component_config = types.ComponentConfig(realm = "realm1", extra = {'key': unicode(key), 'topic': unicode(topic)})
@@ -110,7 +169,7 @@ def wampClient(wampAddress, wampClientEndpoint, topic, key):
     
     ## create a WAMP-over-WebSocket transport client factory    
     #transport_factory = WampWebSocketClientFactory(session_factory, wampAddress, debug = False)
-    transport_factory = MyClientFactory(session_factory, wampAddress, debug = False, debug_wamp = False)
+    transport_factory = MyClientFactory(session_factory, wampAddress, serializers = serializers(binary), debug = False, debug_wamp = False)
     transport_factory.setProtocolOptions(failByDrop = False)
     
     ## start a WebSocket client from an endpoint
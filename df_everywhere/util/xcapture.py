@@ -0,0 +1,673 @@
+# DF Everywhere
+# Copyright (C) 2015  Travis Painter
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# X11 screen capture through the MIT-SHM extension.
+# The X server copies the window straight into a shared memory segment that is kept between frames,
+# and the segment is wrapped as a numpy array without copying.
+# python-xlib finds and measures the window. It has no MIT-SHM support, so the shared image itself
+# is made with libX11 and libXext through ctypes.
+#
+
+import contextlib
+import ctypes
+import ctypes.util
+import time
+
+import numpy
+
+try:
+    import Image
+except:
+    from PIL import Image
+
+from Xlib import X
+from Xlib import display as xdisplay
+from Xlib import error as xerror
+from Xlib.ext import composite, damage
+
+import prettyConsole
+
+_ZPixmap = 2
+_LSBFirst = 0
+_TrueColor = 4
+_IPC_PRIVATE = 0
+_IPC_CREAT = 01000
+_IPC_RMID = 0
+#Each band of damaged rows is a round trip to the X server. Bands closer than this many rows are copied as one,
+#and past this many bands the whole damaged span is copied at once.
+_bandGap = 64
+_maxBands = 3
+
+class _XImage(ctypes.Structure):
+    #Only the leading fields are read
+    _fields_ = [('width', ctypes.c_int), ('height', ctypes.c_int), ('xoffset', ctypes.c_int), ('format', ctypes.c_int),
+                ('data', ctypes.c_void_p), ('byte_order', ctypes.c_int), ('bitmap_unit', ctypes.c_int),
+                ('bitmap_bit_order', ctypes.c_int), ('bitmap_pad', ctypes.c_int), ('depth', ctypes.c_int),
+                ('bytes_per_line', ctypes.c_int), ('bits_per_pixel', ctypes.c_int)]
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [('shmseg', ctypes.c_ulong), ('shmid', ctypes.c_int), ('shmaddr', ctypes.c_void_p), ('readOnly', ctypes.c_int)]
+
+class _XVisualInfo(ctypes.Structure):
+    _fields_ = [('visual', ctypes.c_void_p), ('visualid', ctypes.c_ulong), ('screen', ctypes.c_int), ('depth', ctypes.c_int),
+                ('c_class', ctypes.c_int), ('red_mask', ctypes.c_ulong), ('green_mask', ctypes.c_ulong),
+                ('blue_mask', ctypes.c_ulong), ('colormap_size', ctypes.c_int), ('bits_per_rgb', ctypes.c_int)]
+
+class _XErrorEvent(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_int), ('display', ctypes.c_void_p), ('resourceid', ctypes.c_ulong), ('serial', ctypes.c_ulong),
+                ('error_code', ctypes.c_ubyte), ('request_code', ctypes.c_ubyte), ('minor_code', ctypes.c_ubyte)]
+
+_XErrorHandler = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(_XErrorEvent))
+
+_libs = None
+_lastError = [0]
+
+def _onError(dpy, event):
+    """
+    Remembers X errors instead of letting Xlib exit the process.
+    """
+    _lastError[0] = event.contents.error_code
+    return 0
+
+#Kept at module level so the callback isn't garbage collected
+_errorHandler = _XErrorHandler(_onError)
+
+@contextlib.contextmanager
+def _trapErrors(x11):
+    """
+    Records X errors in _lastError while the block runs.
+    Xlib has one error handler for the whole process and Gtk sets its own, so this one is only installed around
+    calls on the capture's display, and the one before it is put back afterwards.
+    Errors from requests without a reply only arrive after an XSync inside the block.
+    """
+    _lastError[0] = 0
+    previous = x11.XSetErrorHandler(ctypes.cast(_errorHandler, ctypes.c_void_p))
+    try:
+        yield
+    finally:
+        x11.XSetErrorHandler(previous)
+
+def _loadLibraries():
+    """
+    Loads libX11, libXext and libc and declares the functions used. Raises OSError if they aren't installed.
+    """
+    global _libs
+    if _libs is not None:
+        return _libs
+
+    names = [ctypes.util.find_library(lib) for lib in ['X11', 'Xext', 'c']]
+    if None in names:
+        raise OSError("libX11 and libXext are needed for shared memory capture.")
+    x11, xext, libc = [ctypes.CDLL(name, use_errno = True) for name in names]
+
+    x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+    x11.XOpenDisplay.restype = ctypes.c_void_p
+    x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+    x11.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    x11.XDefaultScreen.argtypes = [ctypes.c_void_p]
+    x11.XMatchVisualInfo.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.POINTER(_XVisualInfo)]
+    x11.XSetErrorHandler.argtypes = [ctypes.c_void_p]
+    x11.XSetErrorHandler.restype = ctypes.c_void_p
+    x11.XFree.argtypes = [ctypes.c_void_p]
+
+    xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+    xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.POINTER(_XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint]
+    xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+    xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+    xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+    xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage), ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+
+    libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+    libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+    libc.shmat.restype = ctypes.c_void_p
+    libc.shmdt.argtypes = [ctypes.c_void_p]
+    libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    _libs = (x11, xext, libc)
+    return _libs
+
+def findWindow(title_text, exact = False, disp = None):
+    """
+    Finds a top level window by title with python-xlib. Returns its window id, or None.
+    """
+    if disp is None:
+        disp = xdisplay.Display()
+    netName = disp.intern_atom('_NET_WM_NAME')
+    utf8 = disp.intern_atom('UTF8_STRING')
+
+    windows = [disp.screen().root]
+    while windows:
+        win = windows.pop()
+        try:
+            prop = win.get_full_property(netName, utf8)
+            name = prop.value if prop is not None else win.get_wm_name()
+            children = win.query_tree().children
+        except xerror.XError:
+            #Window went away while walking the tree
+            continue
+        if name:
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            if (name == title_text) if exact else (title_text in name):
+                return win.id
+        windows.extend(children)
+    return None
+
+class WindowTracker:
+    """
+    Finds a window once, then follows it through X events instead of asking the X server or window manager each frame.
+    Its size is kept from ConfigureNotify events. If the window is destroyed, it is looked for again by title
+    every 'retryDelay' seconds until it is back.
+    'generation' goes up whenever the window is found again, resized or mapped, which gives it new contents and storage.
+    'obscured' is True while another window covers part of it, and None until the X server says either way.
+    Under a compositing manager every window counts as uncovered, so it stays None.
+    Other events on the connection, such as damage, are passed to each of 'listeners'.
+    """
+
+    def __init__(self, title = None, window = None, exact = False, displayName = None, retryDelay = 1.0):
+        self.display = xdisplay.Display(displayName)
+        self.title = title
+        self.exact = exact
+        self.retryDelay = retryDelay
+        self.listeners = []
+        self.generation = 0
+        #Counts the windows followed, so a window found again is told apart from the one before it
+        self.found = 0
+
+        #python-xlib window, None while it is gone
+        self.window = None
+        self.width = 0
+        self.height = 0
+        self.border = 0
+        self.depth = 0
+        self.obscured = None
+        self.composited = False
+        self._lastSearch = 0
+
+        if window is None or not self._follow(window):
+            self._find()
+        if self.window is None:
+            self.display.close()
+            raise OSError("Unable to find window.")
+
+    def _find(self):
+        """
+        Looks for the window by title.
+        """
+        self._lastSearch = time.time()
+        if self.title is None:
+            return
+        window = findWindow(self.title, self.exact, self.display)
+        if window is not None and self._follow(window):
+            prettyConsole.console('log', "Found window 0x%x." % window)
+
+    def _follow(self, window):
+        """
+        Starts following a window id. Returns False if it doesn't exist.
+        """
+        win = self.display.create_resource_object('window', window)
+        try:
+            win.change_attributes(event_mask = X.StructureNotifyMask | X.VisibilityChangeMask)
+            geom = win.get_geometry()
+        except xerror.XError:
+            return False
+        self.window = win
+        self.width = geom.width
+        self.height = geom.height
+        self.border = geom.border_width
+        self.depth = geom.depth
+        self.obscured = None
+        #A compositing manager redirects every window, and X then reports them all as uncovered
+        cm = self.display.intern_atom('_NET_WM_CM_S%d' % self.display.get_default_screen())
+        self.composited = self.display.get_selection_owner(cm) != X.NONE
+        self.generation += 1
+        self.found += 1
+        return True
+
+    def readEvents(self):
+        """
+        Handles the X events already received. Never waits on the X server.
+        """
+        while self.display.pending_events():
+            event = self.display.next_event()
+            if event.type in (X.ConfigureNotify, X.MapNotify, X.DestroyNotify, X.VisibilityNotify):
+                if self.window is None or event.window.id != self.window.id:
+                    continue
+                if event.type == X.ConfigureNotify:
+                    if (event.width, event.height, event.border_width) != (self.width, self.height, self.border):
+                        self.width = event.width
+                        self.height = event.height
+                        self.border = event.border_width
+                        self.generation += 1
+                elif event.type == X.MapNotify:
+                    self.generation += 1
+                elif event.type == X.VisibilityNotify:
+                    if not self.composited:
+                        self.obscured = event.state != X.VisibilityUnobscured
+                else:
+                    prettyConsole.console('log', "Window closed. Looking for it again...")
+                    self.window = None
+                    self.generation += 1
+            else:
+                for listener in self.listeners:
+                    listener(event)
+
+        if self.window is None and time.time() - self._lastSearch >= self.retryDelay:
+            self._find()
+
+    def raised(self):
+        """
+        Notes that the window was just brought to the front, so it counts as uncovered until X says otherwise.
+        """
+        if not self.composited:
+            self.obscured = False
+
+    def fileno(self):
+        """
+        The X connection that window events arrive on, to wait for them with select.
+        """
+        return self.display.fileno()
+
+    def close(self):
+        self.display.close()
+
+class ShmCapture:
+    """
+    Captures one window through a persistent MIT-SHM segment.
+    grab() returns the frame as a (height, width, 4) numpy array that shares memory with the segment.
+    It is overwritten by the next grab. The segment is only remade when the window changes size.
+    """
+
+    #Reads what is on screen, so nothing can be grabbed while another window covers this one
+    readsScreen = True
+
+    def __init__(self, window, displayName = None):
+        """
+        'window' is a WindowTracker, or a window id to follow with a new one.
+        """
+        self.x11, self.xext, self.libc = _loadLibraries()
+
+        self._dpy = self.x11.XOpenDisplay(displayName)
+        if not self._dpy:
+            raise OSError("Unable to open X display.")
+        if not self.xext.XShmQueryExtension(self._dpy):
+            self.x11.XCloseDisplay(self._dpy)
+            self._dpy = None
+            raise OSError("X server doesn't support MIT-SHM.")
+        #The window and its size come from python-xlib
+        if isinstance(window, WindowTracker):
+            self.tracker = window
+            self._ownTracker = False
+        else:
+            try:
+                self.tracker = WindowTracker(window = window, displayName = displayName)
+            except:
+                self.x11.XCloseDisplay(self._dpy)
+                self._dpy = None
+                raise
+            self._ownTracker = True
+        self._xlib = self.tracker.display
+
+        self._image = None
+        self._info = None
+        #BGRX or XRGB frame, and an RGB view of it
+        self.frame = None
+        self.rgb = None
+
+    def readEvents(self):
+        """
+        Handles the X events queued for the window.
+        """
+        self.tracker.readEvents()
+
+    def fileno(self):
+        """
+        The X connection that window events arrive on, to wait for them with select.
+        """
+        return self.tracker.fileno()
+
+    def _source(self):
+        """
+        Returns the (drawable, x, y, width, height, depth) to copy each frame from, or None if the window is gone.
+        """
+        self.readEvents()
+        tracker = self.tracker
+        if tracker.window is None:
+            return None
+        return tracker.window.id, 0, 0, tracker.width, tracker.height, tracker.depth
+
+    def _makeImage(self, width, height, depth):
+        """
+        Creates the shared memory segment and image for a window of this size.
+        """
+        self._freeImage()
+        x11, xext, libc = self.x11, self.xext, self.libc
+
+        vinfo = _XVisualInfo()
+        if not x11.XMatchVisualInfo(self._dpy, x11.XDefaultScreen(self._dpy), depth, _TrueColor, ctypes.byref(vinfo)):
+            raise OSError("No TrueColor visual of depth %d." % depth)
+
+        info = _XShmSegmentInfo()
+        image = xext.XShmCreateImage(self._dpy, vinfo.visual, depth, _ZPixmap, None, ctypes.byref(info), width, height)
+        if not image:
+            raise OSError("Unable to create shared memory image.")
+        if image.contents.bits_per_pixel != 32:
+            raise OSError("Shared memory capture needs 32 bits per pixel, not %d." % image.contents.bits_per_pixel)
+
+        size = image.contents.bytes_per_line * height
+        info.shmid = libc.shmget(_IPC_PRIVATE, size, _IPC_CREAT | 0600)
+        if info.shmid < 0:
+            raise OSError(ctypes.get_errno(), "shmget failed")
+        info.shmaddr = libc.shmat(info.shmid, None, 0)
+        if info.shmaddr in (None, ctypes.c_void_p(-1).value):
+            libc.shmctl(info.shmid, _IPC_RMID, None)
+            raise OSError(ctypes.get_errno(), "shmat failed")
+        image.contents.data = info.shmaddr
+        info.readOnly = 0
+        with _trapErrors(x11):
+            xext.XShmAttach(self._dpy, ctypes.byref(info))
+            x11.XSync(self._dpy, 0)
+        #Freed by the system once both sides detach, even if this process dies
+        libc.shmctl(info.shmid, _IPC_RMID, None)
+        if _lastError[0]:
+            #A remote X server can't attach to this machine's shared memory
+            libc.shmdt(info.shmaddr)
+            x11.XFree(ctypes.cast(image, ctypes.c_void_p))
+            raise OSError("X server couldn't attach the shared memory segment (X error %d)." % _lastError[0])
+
+        self._image = image
+        self._info = info
+
+        stride = image.contents.bytes_per_line
+        buf = (ctypes.c_ubyte * size).from_address(info.shmaddr)
+        self.frame = numpy.ndarray((height, width, 4), dtype = numpy.uint8, buffer = buf, strides = (stride, 4, 1))
+        if image.contents.byte_order == _LSBFirst:
+            #B, G, R, X in memory
+            self.rgb = self.frame[..., 2::-1]
+            self._rawMode = 'BGRX'
+        else:
+            self.rgb = self.frame[..., 1:]
+            self._rawMode = 'XRGB'
+        self._stride = stride
+        self._buffer = buf
+
+    def _freeImage(self):
+        if self._image is None:
+            return
+        self.frame = self.rgb = self._buffer = None
+        with _trapErrors(self.x11):
+            self.xext.XShmDetach(self._dpy, ctypes.byref(self._info))
+            self.x11.XSync(self._dpy, 0)
+        self.libc.shmdt(self._info.shmaddr)
+        #Only the XImage struct is left, the data was the segment
+        self.x11.XFree(ctypes.cast(self._image, ctypes.c_void_p))
+        self._image = None
+        self._info = None
+
+    def grab(self):
+        """
+        Copies the window into the shared segment. Returns the (height, width, 4) frame, or None if the window
+        is gone, covered by another window, or can't be read (not mapped, for example).
+        """
+        source = self._source()
+        if source is None:
+            return None
+        if self.readsScreen and self.tracker.obscured:
+            #Covered parts would read as the covering window, and be learned as tiles
+            return None
+        drawable, x, y, width, height, depth = source
+        if width == 0 or height == 0:
+            return None
+        image = self._image
+        if image is None or (image.contents.width, image.contents.height, image.contents.depth) != (width, height, depth):
+            self._makeImage(width, height, depth)
+
+        #Replies to XShmGetImage, so its errors arrive before it returns
+        with _trapErrors(self.x11):
+            ok = self.xext.XShmGetImage(self._dpy, drawable, self._image, x, y, 0xFFFFFFFF)
+        if not ok or _lastError[0]:
+            return None
+        return self.frame
+
+    def screenshot(self, window = None, debug = False):
+        """
+        Same as utils.linux_screenshot: returns an RGB PIL image of the window, or None.
+        'window' is ignored, this always captures the window it was made for.
+        """
+        if self.grab() is None:
+            return None
+        height, width = self.frame.shape[:2]
+        img = Image.frombuffer('RGB', (width, height), self._buffer, 'raw', self._rawMode, self._stride, 1)
+        if debug:
+            img.save("screenshot_shm.png")
+            print("Screenshot saved to screenshot_shm.png.")
+        return img
+
+    def rgbFrame(self, window = None, debug = False):
+        """
+        Like screenshot, but returns the (height, width, 3) RGB view of the shared segment instead of a PIL image.
+        Nothing is copied. It changes with the next grab.
+        """
+        if self.grab() is None:
+            return None
+        if debug:
+            Image.fromarray(self.rgb).save("screenshot_shm.png")
+            print("Screenshot saved to screenshot_shm.png.")
+        return self.rgb
+
+    def close(self):
+        if self._dpy:
+            self._freeImage()
+            self.x11.XCloseDisplay(self._dpy)
+            self._dpy = None
+            if self._ownTracker:
+                self.tracker.close()
+
+class CompositeCapture(ShmCapture):
+    """
+    Captures a window from its offscreen storage with the Composite extension, so it is read correctly even
+    while other windows cover it. The window is never activated or raised.
+    The window is redirected automatically, so the X server still draws it on screen as usual.
+    """
+
+    readsScreen = False
+
+    def __init__(self, window, displayName = None):
+        ShmCapture.__init__(self, window, displayName)
+        self._pixmap = None
+        self._redirected = None
+        self._generation = None
+        if not self._xlib.has_extension('Composite'):
+            ShmCapture.close(self)
+            raise OSError("X server doesn't support Composite.")
+
+    def _source(self):
+        """
+        Returns the window's pixmap, less the border.
+        """
+        self.readEvents()
+        tracker = self.tracker
+        if tracker.window is None:
+            return None
+        if tracker.generation != self._generation:
+            #The window gets new storage when it is mapped or resized, and the pixmap has to be named again
+            self._freePixmap()
+            if self._redirected != tracker.found:
+                tracker.window.composite_redirect_window(composite.RedirectAutomatic)
+                self._redirected = tracker.found
+            self._generation = tracker.generation
+        if self._pixmap is None:
+            #Fails while the window isn't mapped
+            caught = xerror.CatchError()
+            pixmap = tracker.window.composite_name_window_pixmap(onerror = caught)
+            #Named before the shared memory connection uses it
+            self._xlib.sync()
+            if caught.get_error():
+                return None
+            self._pixmap = pixmap
+        return self._pixmap.id, tracker.border, tracker.border, tracker.width, tracker.height, tracker.depth
+
+    def _freePixmap(self):
+        if self._pixmap is not None:
+            self._pixmap.free()
+            self._pixmap = None
+
+    def close(self):
+        if self._dpy:
+            self._freePixmap()
+            if self.tracker.window is not None and self._redirected == self.tracker.found:
+                self.tracker.window.composite_unredirect_window(composite.RedirectAutomatic)
+            self._xlib.sync()
+        ShmCapture.close(self)
+
+class DamageCapture(CompositeCapture):
+    """
+    Composite capture that only copies what the game redrew, using the DAMAGE extension.
+    The first frame, and any frame after the window is resized or mapped, is copied whole. After that, grab()
+    copies only the rows of the window that were damaged since the last grab, and none at all if nothing was.
+    'dirty' lists the damaged (x, y, width, height) rectangles of the last grab, or is None if it was copied whole.
+    'damaged' is True once damage is waiting for the next grab.
+    """
+
+    def __init__(self, window, displayName = None):
+        CompositeCapture.__init__(self, window, displayName)
+        if not self._xlib.has_extension('DAMAGE'):
+            CompositeCapture.close(self)
+            raise OSError("X server doesn't support DAMAGE.")
+        #The server rejects DAMAGE requests until the client has sent its version
+        try:
+            self._xlib.damage_query_version()
+        except Exception, e:
+            CompositeCapture.close(self)
+            raise OSError("DAMAGE version query failed: %s" % e)
+        #python-xlib makes its own event class per display, so events are matched on their code
+        self._notifyCode = self._xlib.extension_event.DamageNotify
+        self._damage = None
+        self._damaged = None
+        self._damageGeneration = None
+        self.tracker.listeners.append(self._handleEvent)
+        #None until the next grab has to copy the whole window
+        self._rects = None
+        self.damaged = True
+        self.dirty = None
+
+    def readEvents(self):
+        """
+        Handles the X events queued for the window. A new, resized or remapped window is copied whole.
+        """
+        tracker = self.tracker
+        tracker.readEvents()
+        if tracker.generation != self._damageGeneration:
+            self._damageGeneration = tracker.generation
+            self._rects = None
+            self.damaged = True
+            if tracker.window is None:
+                #The X server frees the damage object with its window
+                self._damage = None
+            elif self._damaged != tracker.found:
+                #Damage from before the last subtract isn't reported again
+                self._damage = tracker.window.damage_create(damage.DamageReportDeltaRectangles)
+                self._damaged = tracker.found
+
+    def _handleEvent(self, event):
+        if event.type == self._notifyCode and self._damage == event.damage:
+            if self._rects is not None:
+                area = event.area
+                self._rects.append((area.x, area.y, area.width, area.height))
+            self.damaged = True
+
+    def grab(self):
+        """
+        Same as ShmCapture.grab, copying only the damaged rows into the frame.
+        """
+        self.readEvents()
+        if self._damage is None:
+            return None
+        rects = self._rects
+        if rects == [] and self.frame is not None:
+            self.dirty = []
+            return self.frame
+
+        #Anything drawn from here on is reported for the next grab
+        self._xlib.damage_subtract(self._damage)
+        self._xlib.sync()
+        self._rects = []
+        self.damaged = False
+        self.readEvents()
+
+        if rects is None or self.frame is None:
+            self.dirty = None
+            return CompositeCapture.grab(self)
+
+        source = self._source()
+        if source is None:
+            return None
+        drawable, x, y, width, height, depth = source
+        if self.frame.shape[:2] != (height, width):
+            self.dirty = None
+            return CompositeCapture.grab(self)
+
+        bands = _rowBands(rects, height, _bandGap)
+        if len(bands) > _maxBands:
+            bands = [[bands[0][0], bands[-1][1]]]
+        for top, bottom in bands:
+            if not self._grabRows(drawable, x, y, top, bottom):
+                return None
+        self.dirty = rects
+        return self.frame
+
+    def _grabRows(self, drawable, x, y, top, bottom):
+        """
+        Copies rows top to bottom of the window into the same rows of the frame.
+        Shared memory images are read into the segment at their data pointer, so the image is pointed at the
+        first row for the copy. Rows are a whole image width, so the stride doesn't change.
+        """
+        image = self._image.contents
+        height = image.height
+        data = image.data
+        image.height = bottom - top
+        image.data = data + top * self._stride
+        with _trapErrors(self.x11):
+            ok = self.xext.XShmGetImage(self._dpy, drawable, self._image, x, y + top, 0xFFFFFFFF)
+        image.height = height
+        image.data = data
+        return ok and not _lastError[0]
+
+    def close(self):
+        if self._dpy:
+            self.tracker.listeners.remove(self._handleEvent)
+            if self._damage is not None:
+                self._xlib.damage_destroy(self._damage)
+        CompositeCapture.close(self)
+
+def _rowBands(rects, height, gap = 0):
+    """
+    Merges the rows covered by (x, y, width, height) rectangles into (top, bottom) bands, clipped to the window.
+    Bands less than 'gap' rows apart are merged as well.
+    """
+    rows = sorted((max(0, y), min(height, y + h)) for x, y, w, h in rects)
+    bands = []
+    for top, bottom in rows:
+        if bottom <= top:
+            continue
+        if bands and top <= bands[-1][1] + gap:
+            bands[-1][1] = max(bands[-1][1], bottom)
+        else:
+            bands.append([top, bottom])
+    return bands